@@ -240,6 +240,9 @@ ReactorRoomController.RegisterCallback('command_solve',    handlerReactorRoomCon
 ReactorRoomController.RegisterCallback('command_fail',     handlerReactorRoomControllerFail)
 ReactorRoomController.RegisterCallback('ping',             handlerReactorRoomControllerPing)
 ReactorRoomController.RegisterCallback('pong',             handlerReactorRoomControllerPong)
+
+# Don't wait on the room controller, the puzzle is playable as soon as the GPIO is set up
+ReactorRoomController.connect(Blocking = False)
 ########################################################
 ## (END) ROOM CONTROL COMMUNICATION -> REACTOR PUZZLE ##
 ########################################################
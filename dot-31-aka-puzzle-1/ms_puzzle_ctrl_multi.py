@@ -53,12 +53,15 @@ import time
 import gpiozero
 
 from class_puzzle_contact_and import ANDMatchPuzzleContacts as ANDMatchPuzzleContactClass
-from controller_communications import ControllerCommunications
+from controller_communications import ControllerCommunications, ControllerConnection
 
 #FIXME - let's move this to a config file and/or command-line arguments someday
 MQTTserver = 'ms-roomcontroller.local'
 DebugFlag  = True
 
+# Every puzzle on this Pi shares one MQTT connection to the room controller
+RoomConnection = ControllerConnection(MQTTserver)
+
 ######################################
 ## PUZZLE CONTROLLER -> FUEL PUZZLE ##
 ######################################
@@ -113,7 +116,7 @@ def handlerFuelRoomControllerPong():
   pass
 #end def
 
-FuelRoomController = ControllerCommunications('fuel', MQTTserver)
+FuelRoomController = ControllerCommunications('fuel', Connection = RoomConnection)
 
 FuelRoomController.RegisterCallback('command_reboot',   handlerFuelRoomControllerReboot)
 FuelRoomController.RegisterCallback('command_reset',    handlerFuelRoomControllerReset)
@@ -183,7 +186,7 @@ def handlerPowerRoomControllerPong():
   pass
 #end def
 
-PowerRoomController = ControllerCommunications('power', MQTTserver)
+PowerRoomController = ControllerCommunications('power', Connection = RoomConnection)
 
 PowerRoomController.RegisterCallback('command_reboot',   handlerPowerRoomControllerReboot)
 PowerRoomController.RegisterCallback('command_reset',    handlerPowerRoomControllerReset)
@@ -253,7 +256,7 @@ def handlerPressureRoomControllerPong():
   pass
 #end def
 
-PressureRoomController = ControllerCommunications('pressure', MQTTserver)
+PressureRoomController = ControllerCommunications('pressure', Connection = RoomConnection)
 
 PressureRoomController.RegisterCallback('command_reboot',   handlerPressureRoomControllerReboot)
 PressureRoomController.RegisterCallback('command_reset',    handlerPressureRoomControllerReset)
@@ -324,7 +327,7 @@ def handlerPatchRoomControllerPong():
   pass
 #end def
 
-PatchRoomController = ControllerCommunications('patch', MQTTserver)
+PatchRoomController = ControllerCommunications('patch', Connection = RoomConnection)
 
 PatchRoomController.RegisterCallback('command_reboot',   handlerPatchRoomControllerReboot)
 PatchRoomController.RegisterCallback('command_reset',    handlerPatchRoomControllerReset)
@@ -406,7 +409,7 @@ def handlerKeysRoomControllerPong():
   pass
 #end def
 
-KeysRoomController = ControllerCommunications('keys', MQTTserver)
+KeysRoomController = ControllerCommunications('keys', Connection = RoomConnection)
 
 KeysRoomController.RegisterCallback('command_reboot',   handlerKeysRoomControllerReboot)
 KeysRoomController.RegisterCallback('command_reset',    handlerKeysRoomControllerReset)
@@ -464,7 +467,7 @@ def handlerFinalCuesRoomControllerPong():
   pass
 #end def
 
-FinalCuesController = ControllerCommunications('finalcues', MQTTserver)
+FinalCuesController = ControllerCommunications('finalcues', Connection = RoomConnection)
 
 FinalCuesController.RegisterCallback('command_reboot',   handlerFinalCuesRoomControllerReboot)
 FinalCuesController.RegisterCallback('command_reset',    handlerFinalCuesRoomControllerReset)
@@ -485,6 +488,9 @@ FinalCuesController.RegisterCallback('pong',             handlerFinalCuesRoomCon
 ####### MAIN PROGRAM EXECUTION BEGINS HERE #######
 ##################################################
 
+# Don't wait on the room controller, the puzzles are playable as soon as the GPIO is set up
+RoomConnection.connect(Blocking = False)
+
 try:
 
   FuelPuzzle.Reset()
@@ -501,12 +507,9 @@ try:
     PatchPuzzle.ProcessEvents()
     KeysPuzzle.ProcessEvents()
 
-    FuelRoomController.ProcessEvents()
-    PowerRoomController.ProcessEvents()
-    PressureRoomController.ProcessEvents()
-    PatchRoomController.ProcessEvents()
-    KeysRoomController.ProcessEvents()
-    FinalCuesController.ProcessEvents()
+    # Heartbeats to the room controller are scheduled by ControllerCommunications itself, so there
+    # is no reason to spin here.
+    time.sleep(1)
   #end while
   
 except (KeyboardInterrupt, SystemExit):
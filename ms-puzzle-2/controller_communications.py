@@ -36,6 +36,15 @@
 
 
 import paho.mqtt.client as mqtt
+
+# MQTT v5 properties only came along with paho-mqtt 1.5, older versions are limited to 3.1.1
+try:
+  from paho.mqtt.properties import Properties
+  from paho.mqtt.packettypes import PacketTypes
+except ImportError:
+  Properties = None
+#end try
+
 import json
 import time
 import socket
@@ -43,8 +52,16 @@ import uuid
 import re
 import math
 import sys
+import threading
+import random
+import collections
+import heapq
+import os
+import tempfile
+import struct
+import base64
 
-__version__  = '0.9'
+__version__  = '0.10'
 
 print('\r\n----------------------------------------------------------')
 print('Room Controller Communications Class v{}'.format(__version__))
@@ -53,204 +70,408 @@ print('(c)2019 Joel Caturia <jcaturia@katratech.com>')
 print('----------------------------------------------------------\r\n')
 
 
-class ControllerCommunications:
+# Compact heartbeat encoding
+#
+# A JSON heartbeat repeats every key name on every beat. Schema 1 packs the fields we always
+# send into a fixed struct, in network byte order:
+#
+#   version (B)  timestamp (d)  uptime (f)  temperature (h)  state (B)  ipAddress (4s)  MACaddress (6s)
+#
+# followed by puzzleID, role and platform as length-prefixed UTF-8 strings, and then (optionally)
+# a compact JSON object carrying any other fields. The version byte can never be '{', so a
+# decoder tells the two encodings apart from the first byte.
+#
+# Puzzles only send schema 1 once the room controller has said it understands it, by publishing
+# (retained) its highest supported schema number to HEARTBEAT_SCHEMA_TOPIC. Until then they keep
+# sending JSON. The room controller should feed every CIPO/PING payload through DecodeHeartbeat().
+HEARTBEAT_SCHEMA_VERSION = 1
+HEARTBEAT_SCHEMA_TOPIC   = 'COPI/ALL/HEARTBEAT'
 
-  def __init__(self, puzzleID, mqttBroker, mqttPort = 1883):
-    self.mqttBroker = mqttBroker
-    self.mqttPort = mqttPort
-    self.puzzleID = puzzleID
-  
-    self.mqttKeepalive = 15
+HEARTBEAT_STATES = ['RESET', 'ACTIVE', 'SOLVED', 'FAILED', 'REBOOTING', 'UNKNOWN']
 
-    self.__pingDelay = 3
-    self.__timestampLastPing = time.time()
-    self.__puzzleState = None
-    self.__callbacks = {}
-    self.__MQTTConnected = False
+# Publishing anything here makes every puzzle in the room re-send its STATE and a full heartbeat
+SNAPSHOT_TOPIC = 'COPI/ALL/SNAPSHOT'
 
-  def connect(self):
-    
-    def handlerMQTTonConnect(client, userdata, flags, rc):
-      print('>> Puzzle ID [{}] successfully connected to MQTT Broker [{}:{}]..'.format(self.puzzleID, self.mqttBroker, self.mqttPort) )
-      
-      self.__MQTTConnected = True
-      
-      self.mqttClient.subscribe('COPI/' + self.puzzleID + '/#')	# Subscribe to Controller-Out-Puzzle-In		
-      self.mqttClient.subscribe('POPI/' + self.puzzleID + '/#')	# Subscribe to Puzzle-Out-Puzzle-In topic
-      
-      self.PublishState(self.__puzzleState)
-      
-      self.SendPing()
-    #end def (handlerMQTTonConnect)
+# A command published here goes to every puzzle in the room, and one published to
+# COPI/GROUP/<name>/COMMANDS to every puzzle that joined group <name>. Either way it costs one
+# message per Pi, which hands it to all the puzzles it hosts at once.
+ROOM_COMMAND_TOPIC  = 'COPI/ALL/COMMANDS'
+GROUP_COMMAND_TOPIC = 'COPI/GROUP/{}/COMMANDS'
 
+# A ready-made HeartbeatPolicy: beat every second while a puzzle is being played, and every ten
+# while it sits waiting between games. The None entry covers a puzzle that hasn't reported yet.
+ADAPTIVE_HEARTBEAT_POLICY = { 'ACTIVE'    : 1,
+                              'RESET'     : 10,
+                              'SOLVED'    : 10,
+                              'FAILED'    : 10,
+                              'REBOOTING' : 3,
+                              None        : 3 }
 
-    def handlerMQTTonDisconnect(client, userdata, rc):
-        
-      self.__MQTTConnected = False
+_heartbeatHeader = struct.Struct('!BdfhB4s6s')
+_heartbeatFixedFields = ['timestamp', 'uptime', 'temperature', 'currentStatus', 'ipAddress', 'MACaddress', 'puzzleID', 'role', 'platform']
 
-      if self.__puzzleState == 'REBOOTING':
-        self.mqttClient.loop_stop()
-        self.__callbacks['command_reboot']()
-              
-      else:
-        # Try to reconnect, pausing ten seconds if necessary.
-        while True:
-          try:
-            self.mqttClient.reconnect()
-            break
-          except:
-            print(">> reconnect caused exception. sleeping and retrying.")
-            time.sleep(10)
-          
-    #end def (handlerMQTTonDisconnect)
 
-  
-    def handlerMQTTonMessage(client, userdata, message):
-
-      if ('COMMANDS' in message.topic):
-            
-        incomingCommand = message.payload.decode()
-                    
-        if incomingCommand in ['RESET', 'ACTIVATE', 'SOLVE', 'PONG', 'REBOOT', 'FAIL']:
-          print(' -> Received MQTT command: [{}]'.format(incomingCommand))
-                            
-          if incomingCommand == 'RESET':
-            self.__callbacks['command_reset']()
-            
-          elif incomingCommand == 'ACTIVATE':
-            self.__callbacks['command_activate']()
-                            
-          elif incomingCommand == 'SOLVE':
-            self.__callbacks['command_solve']()
-
-          elif incomingCommand == 'FAIL':
-            self.__callbacks['command_fail']()
-
-          elif incomingCommand == 'REBOOT':
-            self.PublishStatus('REBOOTING')
-            self.mqttClient.disconnect()
-            # We fire the command_reboot callback in the on_disconnect event for the MQTT client            
-          #end if
+def EncodeHeartbeat(data):
 
-      elif ('PONG' in message.topic):
-            self.__callbacks['pong']()
-                  
-      else:
-        self.mqttClient.publish('CIPO/' + self.puzzleID + '/ERROR', 'Unknown COMMAND received: [{}]'.format(incomingCommand))
-        self.mqttClient.publish('CIPO/' + self.puzzleID + '/STATE', self.__puzzleState)
+  temperature = data.get('temperature')
+  state = data.get('currentStatus')
+
+  try:
+    packedIP = socket.inet_aton(data.get('ipAddress') or '0.0.0.0')
+  except OSError:
+    packedIP = bytes(4)
+  #end try
+
+  try:
+    packedMAC = bytes.fromhex((data.get('MACaddress') or '').replace(':', ''))[:6].ljust(6, b'\x00')
+  except ValueError:
+    packedMAC = bytes(6)
+  #end try
+
+  payload = bytearray(_heartbeatHeader.pack(
+    HEARTBEAT_SCHEMA_VERSION,
+    data.get('timestamp') or 0,
+    data.get('uptime') or 0,
+    -32768 if temperature is None else int(temperature),
+    255 if state is None else HEARTBEAT_STATES.index(state) if state in HEARTBEAT_STATES else 254,
+    packedIP,
+    packedMAC))
+
+  for fieldName in ['puzzleID', 'role', 'platform']:
+    encodedField = str(data.get(fieldName) or '').encode()[:255]
+    payload.append(len(encodedField))
+    payload.extend(encodedField)
+  #end for
+
+  extraFields = {key: value for key, value in data.items() if key not in _heartbeatFixedFields}
+
+  if len(extraFields) > 0:
+    payload.extend(json.dumps(extraFields, separators=(',', ':')).encode())
+  #end if
+
+  return bytes(payload)
+#end def (EncodeHeartbeat)
+
+
+def DecodeHeartbeat(payload):
+
+  if isinstance(payload, str):
+    payload = payload.encode()
+  #end if
+
+  if payload[:1] == b'{':
+    return json.loads(payload.decode())
+  #end if
+
+  if len(payload) < _heartbeatHeader.size or payload[0] != HEARTBEAT_SCHEMA_VERSION:
+    raise ValueError('Unknown heartbeat encoding (first byte [{}])'.format(payload[:1]))
+  #end if
+
+  version, timestamp, uptime, temperature, state, packedIP, packedMAC = _heartbeatHeader.unpack_from(payload)
+
+  data = {}
+  data['timestamp']     = timestamp
+  data['uptime']        = uptime
+  data['temperature']   = None if temperature == -32768 else temperature
+  data['currentStatus'] = None if state >= len(HEARTBEAT_STATES) else HEARTBEAT_STATES[state]
+  data['ipAddress']     = None if packedIP == bytes(4) else socket.inet_ntoa(packedIP)
+  data['MACaddress']    = None if packedMAC == bytes(6) else ':'.join('{:02x}'.format(octet) for octet in packedMAC)
+
+  offset = _heartbeatHeader.size
+
+  for fieldName in ['puzzleID', 'role', 'platform']:
+    fieldLength = payload[offset]
+    data[fieldName] = payload[offset + 1 : offset + 1 + fieldLength].decode()
+    offset += 1 + fieldLength
+  #end for
+
+  if offset < len(payload):
+    data.update(json.loads(payload[offset:].decode()))
+  #end if
+
+  return data
+#end def (DecodeHeartbeat)
+
+
+
+# Command envelopes
+#
+# A COPI command can still be a bare string ('RESET'), but a room controller that retries (or
+# a QoS 1 redelivery) can then make a puzzle run the same command twice. Wrapping it in an
+# envelope gives every command an ID and the time it was issued:
+#
+#   {"command": "RESET", "id": "a1b2c3", "issued": 1571234567.89}
+#
+# and each puzzle drops a command whose ID it has already seen, or one that was issued too long
+# ago to still make sense. Both fields are optional.
+#
+# An envelope can also say when the command should happen, with "executeAt" on the room
+# controller's clock. Every puzzle translates that to its own clock (using the offset it measured
+# from its PING/PONG exchanges) and holds the command until then, so effects on different Pis
+# fire together instead of whenever the command happened to arrive.
+def EncodeCommand(command, CommandID = None, Issued = None, ExecuteAt = None):
+
+  envelope = {}
+  envelope['command'] = command
+  envelope['id']      = CommandID if CommandID is not None else uuid.uuid4().hex
+  envelope['issued']  = Issued if Issued is not None else time.time()
+
+  if ExecuteAt is not None:
+    envelope['executeAt'] = ExecuteAt
+  #end if
+
+  return json.dumps(envelope, separators=(',', ':'))
+#end def (EncodeCommand)
+
+
+# Returns (command, commandID, issued, executeAt), the last three being None for a bare string command
+def DecodeCommand(payload):
+
+  if isinstance(payload, bytes):
+    payload = payload.decode(errors='replace')
+  #end if
+
+  if payload[:1] == '{':
+    try:
+      envelope = json.loads(payload)
+      commandID = envelope.get('id')
+
+      # The ID is only ever compared and echoed back, so one that isn't a plain value (a list,
+      # say) is kept as its JSON text rather than trip up the duplicate check
+      if commandID is not None and not isinstance(commandID, (str, int, float)):
+        commandID = json.dumps(commandID, sort_keys=True)
       #end if
-                                                                                                                                                                                                                                                                                        
-    #end def (handlerMQTTonMessage)
-## end nested defines (under __init__)
 
-    
-    self.mqttClient = mqtt.Client()
+      return (str(envelope.get('command', '')), commandID, envelope.get('issued'), envelope.get('executeAt'))
 
-    self.mqttClient.on_connect    = handlerMQTTonConnect
-    self.mqttClient.on_disconnect = handlerMQTTonDisconnect
-    self.mqttClient.on_message    = handlerMQTTonMessage
+    except (ValueError, AttributeError):
+      pass
+    #end try
+  #end if
 
-    self.mqttClient.will_set('CIPO/' + self.puzzleID + '/STATE', payload='UNKNOWN', qos=1)
+  return (payload, None, None, None)
+#end def (DecodeCommand)
 
-    backOffTimer = 2
 
-    while (self.__MQTTConnected == False):
-      try:
-        print(">> Attempting MQTT broker connection..")
-        self.mqttClient.connect(self.mqttBroker, self.mqttPort, self.mqttKeepalive)
-        self.mqttClient.loop_start()  
-        time.sleep(1)
-
-      except:
-        print('>> Unable to connect to MQTT broker! Sleeping for {} seconds..'.format(backOffTimer) )
-        time.sleep(backOffTimer)
-        
-        # Incremement the backoff timer util we get over 30, then we just leave it there.
-        if backOffTimer == 30:
-          pass
-        elif backOffTimer > 30:
-          backOffTimer = 30
-        else:
-          backOffTimer = backOffTimer * 2
-        #end if
-        
-      #end try
-    #end while
-        
-  #end def
 
+# HeartbeatAssembler is the room controller's half of delta heartbeats. Feed it every CIPO/PING
+# payload and it hands back the puzzle's full, current heartbeat: keyframes replace what it
+# knows, deltas are merged on top, and uptime is carried forward from the last keyframe (deltas
+# don't repeat it). A jump in the sequence number means a heartbeat went missing; the gap is
+# counted and NeedsKeyframe() stays True until the next keyframe arrives, which can be asked
+# for right away by publishing KeyframeRequest()'s topic and payload. A delta that stands in for
+# several (see CoalesceHeartbeats()) says which sequence number it starts from in 'since'.
+class HeartbeatAssembler:
 
-  def disconnect(self):
-    self.mqttClient.disconnect()
-  #end def (disconnect)  
+  def __init__(self):
+    self.__puzzles = {}
+  #end def (__init__)
 
-  def PublishState(self, state):
-    pass
 
-  def SendPing(self):
+  def Update(self, puzzleID, payload):
 
-    platform = 'RCPCS v{}/Python v{}.{}.{}/{}'.format(__version__, sys.version_info[0], sys.version_info[1], sys.version_info[2], self.__getRaspberryPiVersion() )
- 
-    #TODO - add wireless signal strength as well
-    data = {}
-    data['timestamp']    = time.time()
-    data['puzzleID']     = self.puzzleID
-    data['ipAddress']    = self.__getIPAddress()
-    data['uptime']       = self.__getUptime()
-    data['MACaddress']   = self.__getMACaddress()
-    data['temperature']  = self.__getTemperature()
-    data['role']         = 'puzzle'
-    data['platform']     = platform
-    data['currentStatus'] = self.__puzzleState
-    json_data = json.dumps(data)
-    
-    self.mqttClient.publish('CIPO/PING/' + self.puzzleID, json_data )
-    
-    self.__callbacks['ping']()
-  
-  #end def
-  
+    data = DecodeHeartbeat(payload)
 
-  def ProcessEvents(self):
-  
-    if time.time() - self.__timestampLastPing > self.__pingDelay:        # send a controller ping periodically
-      self.__timestampLastPing = time.time()
-      self.SendPing()
+    entry = self.__puzzles.setdefault(puzzleID, {'state': None, 'sequence': None, 'needsKeyframe': True, 'gapCount': 0, 'uptimeBase': None})
+
+    sequence = data.pop('seq', None)
+    since = data.pop('since', sequence)
+    isKeyframe = data.pop('keyframe', False)
+
+    # Puzzles that don't send deltas: every heartbeat is complete on its own
+    if sequence is None:
+      entry['state'] = data
+      entry['needsKeyframe'] = False
+      return dict(data)
     #end if
-        
-  #end def (ProcessLoop)
 
+    if isKeyframe is False and entry['sequence'] is not None and since != entry['sequence'] + 1:
+      entry['gapCount'] += 1
+      entry['needsKeyframe'] = True
+    #end if
 
-  def PublishStatus(self, newStatus):
-    if newStatus in ['RESET', 'ACTIVE', 'SOLVED', 'FAILED', 'REBOOTING']:
-      self.__puzzleState = newStatus
-      self.mqttClient.publish('CIPO/' + self.puzzleID + '/STATE', self.__puzzleState, qos=1)
+    entry['sequence'] = sequence
+
+    if isKeyframe is True:
+      entry['state'] = data
+      entry['needsKeyframe'] = False
+      entry['uptimeBase'] = (data.get('uptime'), data.get('timestamp'))
+
+    elif entry['state'] is None:
+      return None
+
+    else:
+      entry['state'].update(data)
+
+      uptime, timestamp = entry['uptimeBase']
+
+      if uptime is not None and timestamp is not None and 'timestamp' in data:
+        entry['state']['uptime'] = uptime + (data['timestamp'] - timestamp)
+      #end if
     #end if
-  #end def
-  
-      
-  # These are the callbacks we will support at the moment:
-  # - command_reset 
-  # - command_activate
-  # - command_solve
-  # - command_reboot
-  # - pong
-  def RegisterCallback(self, eventName, callbackFunction):
-  
-    if eventName in ['command_reset', 'command_activate', 'command_solve', 'command_reboot', 'command_fail', 'pong', 'ping']:
-      self.__callbacks[eventName] = callbackFunction
+
+    return dict(entry['state'])
+  #end def (Update)
+
+
+  def NeedsKeyframe(self, puzzleID):
+    return self.__puzzles.get(puzzleID, {'needsKeyframe': True})['needsKeyframe']
+  #end def (NeedsKeyframe)
+
+
+  def GetGapCount(self, puzzleID):
+    return self.__puzzles.get(puzzleID, {'gapCount': 0})['gapCount']
+  #end def (GetGapCount)
+
+
+  def KeyframeRequest(self, puzzleID):
+    return ('COPI/' + puzzleID + '/COMMANDS', 'KEYFRAME')
+  #end def (KeyframeRequest)
+
+#end class (HeartbeatAssembler)
+
+
+# When only one of two heartbeats waiting to go out on a topic is going to be sent, this works out
+# the payload that stands in for both. A complete heartbeat (or keyframe) simply replaces what
+# came before it. A delta only holds what changed since the heartbeat before it, so the older
+# one's fields are folded in: on top of a keyframe it makes a newer keyframe (in the keyframe's
+# encoding), on top of another delta it makes a delta covering both, with 'since' set to the
+# first sequence number it covers. Returns None when the older one isn't sequenced at all, and
+# the two can't be combined.
+def CoalesceHeartbeats(older, newer):
+
+  try:
+    newerData = DecodeHeartbeat(newer)
+    olderData = DecodeHeartbeat(older)
+  except (ValueError, IndexError, struct.error):
+    return newer
+  #end try
+
+  if 'seq' not in newerData or newerData.get('keyframe') is True:
+    return newer
+  #end if
+
+  if 'seq' not in olderData:
+    return None
+  #end if
+
+  merged = dict(olderData)
+  merged.update(newerData)
+
+  if olderData.get('keyframe') is True:
+    merged['keyframe'] = True
+
+    # Deltas leave uptime out, so carry the keyframe's forward
+    if olderData.get('uptime') is not None and 'timestamp' in olderData and 'timestamp' in newerData:
+      merged['uptime'] = olderData['uptime'] + (newerData['timestamp'] - olderData['timestamp'])
     #end if
-        
-  #end def (RegisterCallback)
+
+    if older[:1] not in ['{', b'{']:
+      return EncodeHeartbeat(merged)
+    #end if
+
+    return json.dumps(merged)
+  #end if
+
+  merged['since'] = olderData.get('since', olderData['seq'])
+
+  return json.dumps(merged, separators=(',', ':'))
+#end def (CoalesceHeartbeats)
+
+
+
+# HostTelemetry keeps a ready-made copy of everything a heartbeat reports about the host.
+# The fields that never change (MAC address, Pi model, platform string) are read once at
+# startup, while the ones that do (IP address, temperature) are refreshed by a background
+# sampler at its own pace. Uptime is carried forward from the monotonic clock, so building
+# a heartbeat never touches the filesystem or waits on a name lookup. Given a BrokerResolver,
+# the sampler doesn't look up the broker's name either.
+class HostTelemetry:
+
+  def __init__(self, mqttBroker, SampleInterval = 10, Resolver = None):
+    self.mqttBroker = mqttBroker
+    self.sampleInterval = SampleInterval
+    self.resolver = Resolver
+
+    self.__stopEvent = threading.Event()
+    self.__samplerThread = None
+
+    self.__uptimeBase = self.__getUptime()
+    self.__monotonicBase = time.monotonic()
+
+    platform = 'RCPCS v{}/Python v{}.{}.{}/{}'.format(__version__, sys.version_info[0], sys.version_info[1], sys.version_info[2], self.__getRaspberryPiVersion() )
+
+    snapshot = {}
+    snapshot['ipAddress']   = None
+    snapshot['MACaddress']  = self.__getMACaddress()
+    snapshot['temperature'] = self.__getTemperature()
+    snapshot['platform']    = platform
+
+    # The sampler swaps in a whole new dict, so readers never see a half-updated snapshot
+    self.__snapshot = snapshot
+  #end def (__init__)
+
+
+  def Start(self):
+
+    if self.__samplerThread is not None:
+      return
+    #end if
+
+    self.__samplerThread = threading.Thread(target=self.__samplerLoop, name='rcpcs-telemetry', daemon=True)
+    self.__samplerThread.start()
+  #end def (Start)
+
+
+  def Stop(self):
+    self.__stopEvent.set()
+  #end def (Stop)
+
+
+  def Snapshot(self):
+    snapshot = dict(self.__snapshot)
+    snapshot['uptime'] = self.__uptimeBase + (time.monotonic() - self.__monotonicBase)
+
+    return snapshot
+  #end def (Snapshot)
+
+
+  def Sample(self):
+    snapshot = dict(self.__snapshot)
+    snapshot['ipAddress']   = self.__getIPAddress()
+    snapshot['temperature'] = self.__getTemperature()
+
+    self.__snapshot = snapshot
+  #end def (Sample)
+
+
+  def __samplerLoop(self):
+
+    while not self.__stopEvent.is_set():
+      try:
+        self.Sample()
+      except Exception as e:
+        print('>> Unable to sample host telemetry: [{}]'.format(e))
+      #end try
+
+      self.__stopEvent.wait(self.sampleInterval)
+    #end while
+
+  #end def (__samplerLoop)
 
 
   def __getTemperature(self):
-    with open('/sys/class/thermal/thermal_zone0/temp', 'r') as f:
-      celsius = int(f.readline().strip()) / 1000;
+    try:
+      with open('/sys/class/thermal/thermal_zone0/temp', 'r') as f:
+        celsius = int(f.readline().strip()) / 1000;
 
-      fahrenheit = math.floor((celsius * 1.8) + 32);
+        fahrenheit = math.floor((celsius * 1.8) + 32);
 
-    return fahrenheit
+      return fahrenheit
+
+    except:
+      return None
+    #end try
   #end def (__getTemperature)
   
   
@@ -264,8 +485,10 @@ class ControllerCommunications:
   
   def __getIPAddress(self):
     try: 
+      brokerAddress = self.mqttBroker if self.resolver is None else self.resolver.GetAddress()
+
       s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-      s.connect((self.mqttBroker, 80))  # The server doesn't need to actually be listening on this port for this to work BTW
+      s.connect((brokerAddress, 80))  # The server doesn't need to actually be listening on this port for this to work BTW
 
       host_ip = s.getsockname()[0]
 
@@ -287,12 +510,3356 @@ class ControllerCommunications:
   def __getRaspberryPiVersion(self):
   
     # Only Raspberry Pi's will have this, so we catch the error to mean we're running on some other platform (Simu-Puzzle perhaps?)
-#    try:
-    with open('/proc/device-tree/model', 'r') as f:
-      model = f.readline()
-      return model
+    try:
+      with open('/proc/device-tree/model', 'r') as f:
+        model = f.readline()
+        return model
         
-#    except:
-#      return 'Unknown'
-      #end try
+    except:
+      return 'Unknown'
+    #end try
   #end def (__getRaspberryPiVersion)
+
+#end class (HostTelemetry)
+
+
+
+# BrokerResolver keeps the broker's address on hand so that neither connecting nor a telemetry
+# sample has to wait on a name lookup (resolving ms-roomcontroller.local over mDNS can take
+# hundreds of milliseconds, or time out altogether when avahi is having a bad day). Every broker
+# name is looked up once and then refreshed by a background thread before its TTL runs out. When
+# a lookup fails we keep using the last address we had for that name.
+#
+# The brokers are kept in order of preference, the first one being the primary and the rest
+# fallbacks to try when it can't be reached.
+class BrokerResolver:
+
+  def __init__(self, brokers, TTL = 60, RetryInterval = 5):
+    self.brokers = list(brokers)
+    self.current = self.brokers[0]
+    self.ttl = TTL
+    self.retryInterval = RetryInterval
+
+    self.lookupCount = 0
+    self.failureCount = 0
+    self.lastError = None
+
+    self.__addresses = {}
+    self.__lock = threading.Lock()
+    self.__stopEvent = threading.Event()
+    self.__refreshThread = None
+  #end def (__init__)
+
+
+  def Start(self):
+
+    if self.__refreshThread is not None:
+      return
+    #end if
+
+    self.__refreshThread = threading.Thread(target=self.__refreshLoop, name='rcpcs-resolver', daemon=True)
+    self.__refreshThread.start()
+  #end def (Start)
+
+
+  def Stop(self):
+    self.__stopEvent.set()
+  #end def (Stop)
+
+
+  # Hands back the cached address for a broker (the one last picked by GetBroker() by default).
+  # Only a name we've never managed to resolve is looked up on the spot, and None means that
+  # failed too.
+  def GetAddress(self, broker = None):
+
+    if broker is None:
+      broker = self.current
+    #end if
+
+    with self.__lock:
+      cached = self.__addresses.get(broker)
+    #end with
+
+    if cached is not None:
+      return cached[0]
+    #end if
+
+    return self.Refresh(broker)
+  #end def (GetAddress)
+
+
+  # Which broker a connection attempt should go to. A fresh outage starts with the primary, and
+  # every failed attempt moves one further down the list.
+  def GetBroker(self, attempt):
+    self.current = self.brokers[attempt % len(self.brokers)]
+    return self.current
+  #end def (GetBroker)
+
+
+  def Refresh(self, broker):
+
+    try:
+      address = socket.getaddrinfo(broker, None, socket.AF_INET, socket.SOCK_STREAM)[0][4][0]
+
+    except (socket.error, IndexError) as e:
+      with self.__lock:
+        self.lookupCount += 1
+        self.failureCount += 1
+        self.lastError = '{}: {}'.format(broker, e)
+        cached = self.__addresses.get(broker)
+      #end with
+
+      return cached[0] if cached is not None else None
+    #end try
+
+    with self.__lock:
+      self.lookupCount += 1
+      self.__addresses[broker] = (address, time.monotonic())
+    #end with
+
+    return address
+  #end def (Refresh)
+
+
+  def GetStats(self):
+
+    with self.__lock:
+      addresses = dict((broker, cached[0]) for broker, cached in self.__addresses.items())
+    #end with
+
+    stats = {}
+    stats['addresses']    = addresses
+    stats['lookupCount']  = self.lookupCount
+    stats['failureCount'] = self.failureCount
+    stats['lastError']    = self.lastError
+
+    return stats
+  #end def (GetStats)
+
+
+  # Each name is refreshed once four fifths of its TTL have gone by, and a name that failed
+  # (or was never resolved) gets another go every retryInterval seconds.
+  def __refreshLoop(self):
+
+    while not self.__stopEvent.is_set():
+      now = time.monotonic()
+      nextRefresh = now + (self.ttl * 0.8)
+
+      for broker in self.brokers:
+        with self.__lock:
+          cached = self.__addresses.get(broker)
+        #end with
+
+        if cached is not None and now - cached[1] < self.ttl * 0.8:
+          nextRefresh = min(nextRefresh, cached[1] + (self.ttl * 0.8))
+          continue
+        #end if
+
+        self.Refresh(broker)
+
+        with self.__lock:
+          cached = self.__addresses.get(broker)
+        #end with
+
+        if cached is None or cached[1] < now:
+          nextRefresh = min(nextRefresh, time.monotonic() + self.retryInterval)
+        else:
+          nextRefresh = min(nextRefresh, cached[1] + (self.ttl * 0.8))
+        #end if
+      #end for
+
+      self.__stopEvent.wait(max(0, nextRefresh - time.monotonic()))
+    #end while
+
+  #end def (__refreshLoop)
+
+#end class (BrokerResolver)
+
+
+
+# ReconnectManager decides when the next connection attempt should happen and keeps score.
+# The first retry after a drop is immediate, after that the delay grows exponentially (with
+# jitter so a room full of Pis does not stampede a restarted broker) up to MaxDelay. Waiting
+# is done on an Event, so a pending retry can be cancelled at any time.
+class ReconnectManager:
+
+  def __init__(self, InitialDelay = 0.25, MaxDelay = 10, Multiplier = 2, Jitter = 0.5):
+    self.initialDelay = InitialDelay
+    self.maxDelay = MaxDelay
+    self.multiplier = Multiplier
+    self.jitter = Jitter
+
+    self.reconnectCount = 0
+    self.attemptCount = 0
+    self.lastError = None
+    self.lastOutageDuration = None
+    self.deadSessionCount = 0
+    self.lastDetectionTime = None
+
+    self.__disconnectedAt = None
+    self.__hasConnected = False
+    self.__cancelEvent = threading.Event()
+  #end def (__init__)
+
+
+  # Until the first connection is up we're as good as disconnected, so a broker that's down when
+  # the Pi boots shows in disconnectedFor too. Getting through the first time isn't a reconnect.
+  def Starting(self):
+    self.__disconnectedAt = time.monotonic()
+    self.attemptCount = 0
+  #end def (Starting)
+
+
+  def Disconnected(self, reason = None):
+
+    if self.__disconnectedAt is None:
+      self.__disconnectedAt = time.monotonic()
+      self.attemptCount = 0
+    #end if
+
+    if reason is not None:
+      self.lastError = reason
+    #end if
+  #end def (Disconnected)
+
+
+  def Connected(self):
+
+    if self.__disconnectedAt is not None and self.__hasConnected is True:
+      self.lastOutageDuration = time.monotonic() - self.__disconnectedAt
+      self.reconnectCount += 1
+    #end if
+
+    self.__hasConnected = True
+    self.__disconnectedAt = None
+    self.attemptCount = 0
+  #end def (Connected)
+
+
+  # The link looked up but the room controller had stopped answering, detectionTime seconds after
+  # the last PONG we got
+  def SessionDead(self, detectionTime):
+    self.deadSessionCount += 1
+    self.lastDetectionTime = detectionTime
+    self.Disconnected('no PONG for {:.1f} seconds'.format(detectionTime))
+  #end def (SessionDead)
+
+
+  def AttemptFailed(self, error):
+    self.attemptCount += 1
+    self.lastError = repr(error)
+  #end def (AttemptFailed)
+
+
+  def NextDelay(self):
+
+    if self.attemptCount == 0:
+      return 0
+    #end if
+
+    delay = min(self.maxDelay, self.initialDelay * (self.multiplier ** (self.attemptCount - 1)))
+
+    return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+  #end def (NextDelay)
+
+
+  # Returns True when the wait was cut short by Cancel()
+  def Wait(self, delay):
+    return self.__cancelEvent.wait(delay)
+  #end def (Wait)
+
+
+  def Cancel(self):
+    self.__cancelEvent.set()
+  #end def (Cancel)
+
+
+  def Resume(self):
+    self.__cancelEvent.clear()
+  #end def (Resume)
+
+
+  def IsCancelled(self):
+    return self.__cancelEvent.is_set()
+  #end def (IsCancelled)
+
+
+  def GetStats(self):
+    stats = {}
+    stats['reconnectCount']     = self.reconnectCount
+    stats['attemptCount']       = self.attemptCount
+    stats['lastError']          = self.lastError
+    stats['lastOutageDuration'] = self.lastOutageDuration
+    stats['deadSessionCount']   = self.deadSessionCount
+    stats['lastDetectionTime']  = self.lastDetectionTime
+
+    if self.__disconnectedAt is None:
+      stats['disconnectedFor'] = 0
+    else:
+      stats['disconnectedFor'] = time.monotonic() - self.__disconnectedAt
+    #end if
+
+    return stats
+  #end def (GetStats)
+
+#end class (ReconnectManager)
+
+
+
+# EventScheduler runs small timed jobs (heartbeats and the like) on one background thread, so
+# nothing in this class depends on the host program calling ProcessEvents() in a tight loop.
+# Jobs are kept in a heap ordered by their due time on the monotonic clock. CallLater()
+# hands back a job you can pass to Cancel().
+class EventScheduler:
+
+  def __init__(self, Name = 'rcpcs-scheduler'):
+    self.name = Name
+
+    self.__jobs = []
+    self.__sequence = 0
+    self.__condition = threading.Condition()
+    self.__thread = None
+  #end def (__init__)
+
+
+  def Start(self):
+
+    if self.__thread is not None:
+      return
+    #end if
+
+    self.__thread = threading.Thread(target=self.__schedulerLoop, name=self.name, daemon=True)
+    self.__thread.start()
+  #end def (Start)
+
+
+  def CallLater(self, delay, function):
+    return self.CallAt(time.monotonic() + delay, function)
+  #end def (CallLater)
+
+
+  def CallAt(self, when, function):
+
+    with self.__condition:
+      self.__sequence += 1
+
+      # [due time, tie breaker, function, cancelled]
+      job = [when, self.__sequence, function, False]
+
+      heapq.heappush(self.__jobs, job)
+      self.__condition.notify()
+    #end with
+
+    return job
+  #end def (CallAt)
+
+
+  def Cancel(self, job):
+    if job is not None:
+      job[3] = True
+    #end if
+  #end def (Cancel)
+
+
+  def __schedulerLoop(self):
+
+    while True:
+
+      with self.__condition:
+        while len(self.__jobs) == 0 or self.__jobs[0][3] is True or self.__jobs[0][0] > time.monotonic():
+
+          if len(self.__jobs) > 0 and self.__jobs[0][3] is True:
+            heapq.heappop(self.__jobs)
+            continue
+          #end if
+
+          if len(self.__jobs) == 0:
+            self.__condition.wait()
+          else:
+            self.__condition.wait(self.__jobs[0][0] - time.monotonic())
+          #end if
+        #end while
+
+        job = heapq.heappop(self.__jobs)
+      #end with
+
+      try:
+        job[2]()
+      except Exception as e:
+        print('>> Scheduled job raised an exception: [{}]'.format(e))
+      #end try
+
+    #end while
+
+  #end def (__schedulerLoop)
+
+#end class (EventScheduler)
+
+
+
+# OutboundJournal holds whatever we wanted to publish while the broker was unreachable.
+# Entries that share a key replace each other (so a puzzle that went RESET -> ACTIVE -> SOLVED
+# offline only owes the room controller its SOLVED), entries can carry an expiry so stale
+# heartbeats are dropped instead of replayed, and the whole journal is mirrored to a small
+# file (on tmpfs by default) so it survives a restart of the puzzle process. The file is only
+# rewritten while we're offline, which keeps SD card writes to a minimum.
+class OutboundJournal:
+
+  def __init__(self, MaxEntries = 256):
+    self.path = None
+    self.maxEntries = MaxEntries
+
+    self.droppedCount = 0
+    self.expiredCount = 0
+
+    self.__entries = collections.OrderedDict()
+    self.__sequence = 0
+    self.__lock = threading.Lock()
+  #end def (__init__)
+
+
+  def __len__(self):
+    return len(self.__entries)
+  #end def (__len__)
+
+
+  # Anything already queued in memory is newer than what's on disk, so it wins
+  def Open(self, path):
+    self.path = path
+
+    try:
+      with open(path, 'r') as f:
+        storedEntries = json.load(f)
+
+    except FileNotFoundError:
+      storedEntries = []
+
+    except (OSError, ValueError) as e:
+      print('>> Ignoring unreadable outbound journal [{}]: [{}]'.format(path, e))
+      storedEntries = []
+    #end try
+
+    with self.__lock:
+      queuedEntries = self.__entries
+      self.__entries = collections.OrderedDict()
+
+      for entry in storedEntries:
+        self.__entries[entry['key']] = entry
+      #end for
+
+      for key, entry in queuedEntries.items():
+        self.__entries.pop(key, None)
+        self.__entries[key] = entry
+      #end for
+
+      self.__trim()
+      self.__save()
+    #end with
+
+    if len(storedEntries) > 0:
+      print('>> Recovered {} message(s) from outbound journal [{}]'.format(len(storedEntries), path))
+    #end if
+  #end def (Open)
+
+
+  def Put(self, topic, payload, qos = 0, retain = False, Key = None, TimeToLive = None, CorrelationData = None):
+
+    with self.__lock:
+      self.__sequence += 1
+
+      if Key is None:
+        Key = '{}#{}'.format(time.time(), self.__sequence)
+      #end if
+
+      entry = {}
+      entry['key']     = Key
+      entry['topic']   = topic
+      entry['payload'] = payload
+      entry['base64']  = False
+
+      # Binary payloads (compact heartbeats) are stored base64 encoded so the journal stays plain JSON
+      if isinstance(payload, (bytes, bytearray)):
+        entry['payload'] = base64.b64encode(payload).decode()
+        entry['base64']  = True
+      #end if
+      entry['qos']     = qos
+      entry['retain']  = retain
+      entry['expires'] = None if TimeToLive is None else time.time() + TimeToLive
+      entry['correlation'] = None if CorrelationData is None else base64.b64encode(CorrelationData).decode()
+
+      # Re-inserting moves a coalesced entry to the back, so the journal drains in the order things last changed
+      self.__entries.pop(Key, None)
+      self.__entries[Key] = entry
+
+      self.__trim()
+      self.__save()
+    #end with
+
+  #end def (Put)
+
+
+  # Hands back everything still worth sending, oldest first, and empties the journal
+  def Drain(self):
+
+    with self.__lock:
+      entries = list(self.__entries.values())
+      self.__entries.clear()
+
+      if self.path is not None:
+        try:
+          os.remove(self.path)
+        except OSError:
+          pass
+        #end try
+      #end if
+    #end with
+
+    now = time.time()
+    liveEntries = [entry for entry in entries if entry['expires'] is None or entry['expires'] > now]
+
+    self.expiredCount += len(entries) - len(liveEntries)
+
+    for entry in liveEntries:
+      if entry.get('base64') is True:
+        entry['payload'] = base64.b64decode(entry['payload'])
+      #end if
+
+      if entry.get('correlation') is not None:
+        entry['correlation'] = base64.b64decode(entry['correlation'])
+      #end if
+    #end for
+
+    return liveEntries
+  #end def (Drain)
+
+
+  def __trim(self):
+    while len(self.__entries) > self.maxEntries:
+      self.__entries.popitem(last = False)
+      self.droppedCount += 1
+    #end while
+  #end def (__trim)
+
+
+  def __save(self):
+
+    if self.path is None:
+      return
+    #end if
+
+    try:
+      tmpPath = self.path + '.tmp'
+
+      with open(tmpPath, 'w') as f:
+        json.dump(list(self.__entries.values()), f)
+      #end with
+
+      os.replace(tmpPath, self.path)
+
+    except (OSError, TypeError, ValueError) as e:
+      print('>> Unable to write outbound journal [{}]: [{}]'.format(self.path, e))
+    #end try
+
+  #end def (__save)
+
+#end class (OutboundJournal)
+
+
+
+# TopicRouter turns an incoming topic into a handler with one split and (usually) one dict
+# lookup. Plain routes such as COPI/<puzzleID>/COMMANDS are stored as tuples of topic segments,
+# so the (prefix, puzzleID, verb) of an incoming message finds its handler directly. Routes
+# with MQTT wildcards (+ for one level, # for the rest) are kept in a short list, sorted so the
+# most specific pattern is tried first, and are only consulted when there's no exact hit.
+#
+# Handlers are called as handler(message, topicSegments).
+class TopicRouter:
+
+  def __init__(self):
+    self.__exactRoutes = {}
+    self.__patternRoutes = []
+  #end def (__init__)
+
+
+  def AddRoute(self, pattern, handler):
+
+    segments = tuple(pattern.split('/'))
+
+    if '#' in segments[:-1]:
+      raise ValueError('Topic pattern [{}] may only use # as its last level'.format(pattern))
+    #end if
+
+    if '+' not in segments and '#' not in segments:
+      self.__exactRoutes[segments] = handler
+      return
+    #end if
+
+    self.__patternRoutes = [route for route in self.__patternRoutes if route[0] != segments]
+    self.__patternRoutes.append( (segments, handler) )
+
+    # Trailing # patterns go last, then the ones with more + levels, then the shorter ones
+    self.__patternRoutes.sort(key = lambda route: (route[0][-1] == '#', route[0].count('+'), -len(route[0])))
+  #end def (AddRoute)
+
+
+  def RemoveRoute(self, pattern):
+    segments = tuple(pattern.split('/'))
+
+    self.__exactRoutes.pop(segments, None)
+    self.__patternRoutes = [route for route in self.__patternRoutes if route[0] != segments]
+  #end def (RemoveRoute)
+
+
+  def Route(self, topic):
+
+    segments = tuple(topic.split('/'))
+
+    handler = self.__exactRoutes.get(segments)
+
+    if handler is None:
+      for patternSegments, patternHandler in self.__patternRoutes:
+        if self.__matches(patternSegments, segments):
+          handler = patternHandler
+          break
+        #end if
+      #end for
+    #end if
+
+    return handler, segments
+  #end def (Route)
+
+
+  def Dispatch(self, message):
+
+    handler, segments = self.Route(message.topic)
+
+    if handler is None:
+      return False
+    #end if
+
+    handler(message, segments)
+
+    return True
+  #end def (Dispatch)
+
+
+  def __matches(self, patternSegments, topicSegments):
+
+    for index, patternSegment in enumerate(patternSegments):
+
+      # '#' also matches the parent level, so 'COPI/fuel/#' covers 'COPI/fuel' as well
+      if patternSegment == '#':
+        return True
+      #end if
+
+      if index >= len(topicSegments):
+        return False
+      #end if
+
+      if patternSegment != '+' and patternSegment != topicSegments[index]:
+        return False
+      #end if
+    #end for
+
+    return len(patternSegments) == len(topicSegments)
+  #end def (__matches)
+
+#end class (TopicRouter)
+
+
+
+# CommandFilter remembers the IDs of the last few enveloped commands a puzzle has accepted, and
+# turns away repeats as well as commands that were issued more than MaxAge seconds ago. When we
+# have an estimate of the room controller's clock offset it's taken into account, so a Pi whose
+# clock has drifted doesn't throw away perfectly good commands.
+class CommandFilter:
+
+  def __init__(self, HistorySize = 128, MaxAge = 30):
+    self.historySize = HistorySize
+    self.maxAge = MaxAge
+
+    self.duplicateCount = 0
+    self.staleCount = 0
+
+    self.__seen = collections.OrderedDict()
+    self.__lock = threading.Lock()
+  #end def (__init__)
+
+
+  # Returns None when the command should run, otherwise the reason it was dropped
+  def Check(self, commandID, issued, ClockOffset = None):
+
+    if issued is not None and self.maxAge is not None:
+      try:
+        age = time.time() - (float(issued) - (ClockOffset or 0))
+      except (TypeError, ValueError):
+        age = 0
+      #end try
+
+      if age > self.maxAge:
+        self.staleCount += 1
+        return 'stale'
+      #end if
+    #end if
+
+    if commandID is None:
+      return None
+    #end if
+
+    with self.__lock:
+      if commandID in self.__seen:
+        self.__seen.move_to_end(commandID)
+        self.duplicateCount += 1
+        return 'duplicate'
+      #end if
+
+      self.__seen[commandID] = time.monotonic()
+
+      while len(self.__seen) > self.historySize:
+        self.__seen.popitem(last = False)
+      #end while
+    #end with
+
+    return None
+  #end def (Check)
+
+
+  # For a command that was accepted but never got to run, so a retry with the same ID isn't
+  # turned away as a duplicate
+  def Forget(self, commandID):
+    with self.__lock:
+      self.__seen.pop(commandID, None)
+    #end with
+  #end def (Forget)
+
+
+  def GetStats(self):
+    stats = {}
+    stats['duplicates'] = self.duplicateCount
+    stats['stale']      = self.staleCount
+
+    return stats
+  #end def (GetStats)
+
+#end class (CommandFilter)
+
+
+
+# CallbackExecutor runs a puzzle's callbacks, in the order they were submitted, on a worker
+# thread of its own. Prop code is free to sleep, blink and poke GPIO for as long as it likes;
+# the MQTT network thread only ever drops a job in the queue and gets straight back to its
+# keepalives and PONGs. The queue is bounded, and a job that doesn't fit is dropped (and
+# counted) rather than stalling the network thread.
+#
+# A job can carry a Done function, which is called once it has run with the job's queued,
+# started and finished times (monotonic clock) and its outcome: 'ok', or 'error: ...'.
+#
+# An Urgent job (a command cued for a given moment) goes ahead of everything that's waiting. It
+# still waits for the job that's running to finish, since prop code is never run on two threads.
+class CallbackExecutor:
+
+  def __init__(self, name, MaxQueueDepth = 64):
+    self.name = name
+    self.maxQueueDepth = MaxQueueDepth
+
+    self.__jobs = collections.deque()
+    self.__urgentJobs = collections.deque()
+    self.__thread = None
+    self.__condition = threading.Condition()
+
+    self.__stats = {}
+    self.__stats['submitted']     = 0
+    self.__stats['completed']     = 0
+    self.__stats['failed']        = 0
+    self.__stats['dropped']       = 0
+    self.__stats['maxQueueDepth'] = 0
+    self.__stats['lastRunTime']   = 0
+    self.__stats['maxRunTime']    = 0
+    self.__stats['totalRunTime']  = 0
+    self.__stats['maxQueueWait']  = 0
+    self.__stats['totalQueueWait'] = 0
+  #end def (__init__)
+
+
+  def Submit(self, function, *args, Done = None, Urgent = False):
+
+    with self.__condition:
+      if self.__thread is None:
+        self.__thread = threading.Thread(target=self.__workerLoop, name='rcpcs-callbacks-' + self.name, daemon=True)
+        self.__thread.start()
+      #end if
+
+      if self.__depth() >= self.maxQueueDepth:
+        self.__stats['dropped'] += 1
+        print('>> Callback queue for [{}] is full, dropping [{}]'.format(self.name, getattr(function, '__name__', function)))
+        return False
+      #end if
+
+      if Urgent is True:
+        self.__urgentJobs.append( (time.monotonic(), function, args, Done) )
+      else:
+        self.__jobs.append( (time.monotonic(), function, args, Done) )
+      #end if
+
+      self.__stats['submitted'] += 1
+      self.__stats['maxQueueDepth'] = max(self.__stats['maxQueueDepth'], self.__depth())
+
+      self.__condition.notify()
+    #end with
+
+    return True
+  #end def (Submit)
+
+
+  def GetStats(self):
+    stats = dict(self.__stats)
+
+    with self.__condition:
+      stats['queueDepth'] = self.__depth()
+    #end with
+
+    finished = stats['completed'] + stats['failed']
+    stats['averageRunTime']   = stats['totalRunTime'] / finished if finished > 0 else 0
+    stats['averageQueueWait'] = stats['totalQueueWait'] / finished if finished > 0 else 0
+
+    return stats
+  #end def (GetStats)
+
+
+  def __workerLoop(self):
+
+    while True:
+
+      with self.__condition:
+        while self.__depth() == 0:
+          self.__condition.wait()
+        #end while
+
+        if len(self.__urgentJobs) > 0:
+          queuedAt, function, args, done = self.__urgentJobs.popleft()
+        else:
+          queuedAt, function, args, done = self.__jobs.popleft()
+        #end if
+      #end with
+
+      self.__runJob(queuedAt, function, args, done)
+    #end while
+
+  #end def (__workerLoop)
+
+
+  def __depth(self):
+    return len(self.__jobs) + len(self.__urgentJobs)
+  #end def (__depth)
+
+
+  def __runJob(self, queuedAt, function, args, done):
+
+    startedAt = time.monotonic()
+
+    try:
+      function(*args)
+      self.__stats['completed'] += 1
+      outcome = 'ok'
+
+    except Exception as e:
+      self.__stats['failed'] += 1
+      outcome = 'error: {}'.format(e)
+      print('>> Callback [{}] for [{}] raised an exception: [{}]'.format(getattr(function, '__name__', function), self.name, e))
+    #end try
+
+    finishedAt = time.monotonic()
+
+    if done is not None:
+      try:
+        done(queuedAt, startedAt, finishedAt, outcome)
+      except Exception as e:
+        print('>> Completion of callback [{}] for [{}] raised an exception: [{}]'.format(getattr(function, '__name__', function), self.name, e))
+      #end try
+    #end if
+
+    runTime = finishedAt - startedAt
+    queueWait = startedAt - queuedAt
+
+    self.__stats['lastRunTime']     = runTime
+    self.__stats['maxRunTime']      = max(self.__stats['maxRunTime'], runTime)
+    self.__stats['totalRunTime']   += runTime
+    self.__stats['maxQueueWait']    = max(self.__stats['maxQueueWait'], queueWait)
+    self.__stats['totalQueueWait'] += queueWait
+  #end def (__runJob)
+
+#end class (CallbackExecutor)
+
+
+
+# PublishTracker follows every QoS 1/2 message from the moment we hand it to paho until the
+# broker acknowledges it, and keeps a histogram of how long that took. Anything still waiting
+# after StuckThreshold seconds is reported as stuck, which is usually the first sign that the
+# broker or the Wi-Fi is the bottleneck. WaitForAck() lets a caller block (with a deadline)
+# until a particular message has made it.
+class PublishTracker:
+
+  LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+  # An early ack is picked up the moment publish() returns, anything older than this never will be
+  EARLY_ACK_AGE = 5
+
+  def __init__(self, StuckThreshold = 5):
+    self.stuckThreshold = StuckThreshold
+
+    self.__inFlight = {}
+    self.__earlyAcks = {}
+    self.__reserved = 0
+    self.__acked = collections.OrderedDict()
+    self.__lock = threading.Lock()
+
+    self.__histogram = [0] * (len(self.LATENCY_BUCKETS) + 1)
+    self.__ackedCount = 0
+    self.__totalLatency = 0
+    self.__maxLatency = 0
+    self.__lastLatency = None
+  #end def (__init__)
+
+
+  # Says a QoS 1 or 2 message is on its way to paho, so an ack that turns up before Track() is
+  # kept for it. Every Reserve() is settled with Track() or Release().
+  def Reserve(self):
+    with self.__lock:
+      self.__reserved += 1
+    #end with
+  #end def (Reserve)
+
+
+  def Release(self):
+    with self.__lock:
+      self.__reserved -= 1
+    #end with
+  #end def (Release)
+
+
+  def Track(self, messageInfo, topic):
+
+    with self.__lock:
+      self.__reserved -= 1
+
+      # paho can report the message as sent before publish() has even returned to us
+      if messageInfo.mid in self.__earlyAcks:
+        self.__recordLatency(time.monotonic() - self.__earlyAcks.pop(messageInfo.mid))
+        self.__rememberAck(messageInfo.mid)
+        return
+      #end if
+
+      self.__inFlight[messageInfo.mid] = {'topic': topic, 'sentAt': time.monotonic(), 'event': threading.Event(), 'acked': False}
+    #end with
+  #end def (Track)
+
+
+  def Acknowledged(self, mid):
+
+    with self.__lock:
+      entry = self.__inFlight.pop(mid, None)
+
+      if entry is None:
+        now = time.monotonic()
+
+        # QoS 0 messages are reported too, but only while a tracked message is on its way could this
+        # be one we're about to be handed
+        if self.__reserved > 0:
+          self.__earlyAcks[mid] = now
+        #end if
+
+        while len(self.__earlyAcks) > 0 and now - next(iter(self.__earlyAcks.values())) > self.EARLY_ACK_AGE:
+          self.__earlyAcks.pop(next(iter(self.__earlyAcks)))
+        #end while
+
+        return
+      #end if
+
+      self.__recordLatency(time.monotonic() - entry['sentAt'])
+      self.__rememberAck(mid)
+      entry['acked'] = True
+    #end with
+
+    entry['event'].set()
+  #end def (Acknowledged)
+
+
+  # True once the broker has acknowledged mid. A message we never tracked (one paho refused to
+  # send, say) was never acknowledged, and gets False straight away.
+  def WaitForAck(self, mid, timeout):
+
+    with self.__lock:
+      if mid in self.__acked:
+        return True
+      #end if
+
+      entry = self.__inFlight.get(mid)
+    #end with
+
+    if entry is None:
+      return False
+    #end if
+
+    return entry['event'].wait(timeout) is True and entry['acked'] is True
+  #end def (WaitForAck)
+
+
+  # A new paho client never sends what the old one had in flight, and its message IDs start over.
+  # Anyone still waiting on one of those messages is told it wasn't acknowledged.
+  def NewSession(self):
+
+    with self.__lock:
+      entries = list(self.__inFlight.values())
+
+      self.__inFlight.clear()
+      self.__earlyAcks.clear()
+      self.__acked.clear()
+    #end with
+
+    for entry in entries:
+      entry['event'].set()
+    #end for
+  #end def (NewSession)
+
+
+  def HasStuckMessages(self):
+    return self.GetStats()['stuck'] > 0
+  #end def (HasStuckMessages)
+
+
+  def GetStats(self):
+
+    now = time.monotonic()
+
+    with self.__lock:
+      ages = [now - entry['sentAt'] for entry in self.__inFlight.values()]
+
+      stats = {}
+      stats['inFlight']       = len(ages)
+      stats['stuck']          = len([age for age in ages if age > self.stuckThreshold])
+      stats['oldestInFlight'] = max(ages) if len(ages) > 0 else 0
+      stats['acked']          = self.__ackedCount
+      stats['lastLatency']    = self.__lastLatency
+      stats['maxLatency']     = self.__maxLatency
+      stats['averageLatency'] = self.__totalLatency / self.__ackedCount if self.__ackedCount > 0 else 0
+
+      histogram = collections.OrderedDict()
+
+      for index, bucket in enumerate(self.LATENCY_BUCKETS):
+        histogram['<={}ms'.format(int(bucket * 1000))] = self.__histogram[index]
+      #end for
+
+      histogram['>{}ms'.format(int(self.LATENCY_BUCKETS[-1] * 1000))] = self.__histogram[-1]
+
+      stats['histogram'] = histogram
+    #end with
+
+    return stats
+  #end def (GetStats)
+
+
+  # The last few acknowledged message IDs, for a WaitForAck() that comes after the fact
+  def __rememberAck(self, mid):
+
+    self.__acked[mid] = True
+    self.__acked.move_to_end(mid)
+
+    while len(self.__acked) > 256:
+      self.__acked.popitem(last = False)
+    #end while
+  #end def (__rememberAck)
+
+
+  def __recordLatency(self, latency):
+
+    bucketIndex = len(self.LATENCY_BUCKETS)
+
+    for index, bucket in enumerate(self.LATENCY_BUCKETS):
+      if latency <= bucket:
+        bucketIndex = index
+        break
+      #end if
+    #end for
+
+    self.__histogram[bucketIndex] += 1
+    self.__ackedCount += 1
+    self.__totalLatency += latency
+    self.__maxLatency = max(self.__maxLatency, latency)
+    self.__lastLatency = latency
+  #end def (__recordLatency)
+
+#end class (PublishTracker)
+
+
+
+# TokenBucket allows Rate events a second on average, in bursts of up to Burst at a time. It
+# isn't thread safe, so whoever owns it does the locking.
+class TokenBucket:
+
+  def __init__(self, Rate, Burst):
+    self.rate = Rate
+    self.burst = Burst
+
+    self.__tokens = Burst
+    self.__refilledAt = time.monotonic()
+  #end def (__init__)
+
+
+  def Take(self):
+
+    now = time.monotonic()
+
+    self.__tokens = min(self.burst, self.__tokens + (now - self.__refilledAt) * self.rate)
+    self.__refilledAt = now
+
+    if self.__tokens < 1:
+      return False
+    #end if
+
+    self.__tokens -= 1
+
+    return True
+  #end def (Take)
+
+#end class (TokenBucket)
+
+
+
+# InboundLimiter keeps a misbehaving publisher (or a retained message stuck in a loop) from
+# eating every Pi's time. Each topic gets a token bucket of its own, and a message that repeats
+# the last one on its topic within CoalesceWindow seconds is dropped as well. It's only ever
+# called from the network thread.
+#
+# Check() says why a message was dropped ('coalesced' or 'rate_limited'), or None when it's let in.
+class InboundLimiter:
+
+  def __init__(self, Rate = 20, Burst = 40, CoalesceWindow = 0.5, MaxTopics = 256):
+    self.rate = Rate
+    self.burst = Burst
+    self.coalesceWindow = CoalesceWindow
+    self.maxTopics = MaxTopics
+
+    self.admittedCount = 0
+    self.rateLimitedCount = 0
+    self.coalescedCount = 0
+
+    # topic -> [TokenBucket, last payload, when it came in, limited]
+    self.__topics = collections.OrderedDict()
+  #end def (__init__)
+
+
+  def Admit(self, topic, payload):
+    return self.Check(topic, payload) is None
+  #end def (Admit)
+
+
+  def Check(self, topic, payload):
+
+    now = time.monotonic()
+
+    entry = self.__topics.get(topic)
+
+    if entry is None:
+      entry = [TokenBucket(self.rate, self.burst), None, None, False]
+      self.__topics[topic] = entry
+
+      while len(self.__topics) > self.maxTopics:
+        self.__topics.popitem(last = False)
+      #end while
+
+    else:
+      self.__topics.move_to_end(topic)
+    #end if
+
+    if entry[1] == payload and now - entry[2] < self.coalesceWindow:
+      self.coalescedCount += 1
+      return 'coalesced'
+    #end if
+
+    if entry[0].Take() is False:
+      self.rateLimitedCount += 1
+
+      if entry[3] is False:
+        print('>> Too many messages on [{}], dropping some'.format(topic))
+        entry[3] = True
+      #end if
+
+      return 'rate_limited'
+    #end if
+
+    entry[1] = payload
+    entry[2] = now
+    entry[3] = False
+
+    self.admittedCount += 1
+
+    return None
+  #end def (Check)
+
+
+  def GetStats(self):
+    stats = {}
+    stats['admitted']    = self.admittedCount
+    stats['rateLimited'] = self.rateLimitedCount
+    stats['coalesced']   = self.coalescedCount
+
+    return stats
+  #end def (GetStats)
+
+#end class (InboundLimiter)
+
+
+
+# OutboundQueue sits between Publish() and paho, whose own queue is unbounded and strictly first
+# in, first out. Only Window messages are handed to paho at a time (each one counts until paho
+# reports it published), and anything beyond that waits here in priority order. STATE and ACK
+# messages are never held back, errors are rate limited, and a newer heartbeat takes the place
+# of one that is still waiting instead of queueing up behind it (a delta heartbeat takes the
+# waiting one's changes along with it, see CoalesceHeartbeats()). The queue is bounded: when it's
+# full, the oldest of the least important messages makes way.
+class OutboundQueue:
+
+  PRIORITY_CRITICAL  = 0
+  PRIORITY_ERROR     = 1
+  PRIORITY_NORMAL    = 2
+  PRIORITY_HEARTBEAT = 3
+
+  def __init__(self, MaxDepth = 64, Window = 8, ErrorRate = 1, ErrorBurst = 5):
+    self.maxDepth = MaxDepth
+    self.window = Window
+
+    self.__queues = [collections.deque() for priority in range(4)]
+    self.__keyed = {}
+    self.__pending = set()
+    self.__earlyAcks = set()
+    self.__reserved = 0
+    self.__errorBucket = TokenBucket(ErrorRate, ErrorBurst)
+    self.__lock = threading.Lock()
+
+    self.__stats = {}
+    self.__stats['queued']        = 0
+    self.__stats['replaced']      = 0
+    self.__stats['dropped']       = 0
+    self.__stats['expired']       = 0
+    self.__stats['errorsLimited'] = 0
+    self.__stats['maxDepth']      = 0
+  #end def (__init__)
+
+
+  def Classify(self, topic):
+
+    if topic.endswith('/STATE') or topic.endswith('/ACK'):
+      return self.PRIORITY_CRITICAL
+    #end if
+
+    if topic.endswith('/ERROR'):
+      return self.PRIORITY_ERROR
+    #end if
+
+    if topic.startswith('CIPO/PING/') or topic.endswith('/PING'):
+      return self.PRIORITY_HEARTBEAT
+    #end if
+
+    return self.PRIORITY_NORMAL
+  #end def (Classify)
+
+
+  # Returns False for an error message over the rate limit, which should be dropped
+  def Admit(self, priority):
+
+    if priority != self.PRIORITY_ERROR:
+      return True
+    #end if
+
+    with self.__lock:
+      if self.__errorBucket.Take() is False:
+        self.__stats['errorsLimited'] += 1
+        return False
+      #end if
+    #end with
+
+    return True
+  #end def (Admit)
+
+
+  # Claims a place in paho's window, which a critical message (Force) always gets. Every claim is
+  # settled with Sent() or Release().
+  def Reserve(self, Force = False):
+
+    with self.__lock:
+      if Force is False and (self.__depth() > 0 or len(self.__pending) + self.__reserved >= self.window):
+        return False
+      #end if
+
+      self.__reserved += 1
+    #end with
+
+    return True
+  #end def (Reserve)
+
+
+  def Sent(self, mid):
+
+    with self.__lock:
+      self.__reserved -= 1
+
+      # paho can report a QoS 0 message published before publish() has even returned its mid
+      if mid in self.__earlyAcks:
+        self.__earlyAcks.discard(mid)
+      else:
+        self.__pending.add(mid)
+      #end if
+    #end with
+  #end def (Sent)
+
+
+  def Release(self):
+    with self.__lock:
+      self.__reserved -= 1
+    #end with
+  #end def (Release)
+
+
+  def Acknowledged(self, mid):
+
+    with self.__lock:
+      if mid in self.__pending:
+        self.__pending.discard(mid)
+      elif self.__reserved > 0:
+        self.__earlyAcks.add(mid)
+      #end if
+    #end with
+  #end def (Acknowledged)
+
+
+  # Whatever paho had in flight on the last connection no longer holds a place in the window
+  def NewSession(self):
+    with self.__lock:
+      self.__pending.clear()
+      self.__earlyAcks.clear()
+    #end with
+  #end def (NewSession)
+
+
+  def Put(self, entry):
+
+    with self.__lock:
+      key = entry.get('key')
+
+      if key is not None and key in self.__keyed:
+        waiting = self.__keyed[key]
+        payload = entry['payload']
+
+        if entry['priority'] == self.PRIORITY_HEARTBEAT:
+          payload = CoalesceHeartbeats(waiting['payload'], entry['payload'])
+        #end if
+
+        # Otherwise the two can't be combined, and the newer one is queued behind the other
+        if payload is not None:
+          waiting.update(entry)
+          waiting['payload'] = payload
+          self.__stats['replaced'] += 1
+          return
+        #end if
+      #end if
+
+      if self.__depth() >= self.maxDepth:
+        victimPriority = max(priority for priority in range(4) if len(self.__queues[priority]) > 0)
+
+        # Nothing waiting is less important than this message, so it's the one that goes
+        if victimPriority < entry['priority']:
+          self.__stats['dropped'] += 1
+          return
+        #end if
+
+        victim = self.__queues[victimPriority].popleft()
+        self.__forget(victim)
+        self.__stats['dropped'] += 1
+      #end if
+
+      self.__queues[entry['priority']].append(entry)
+
+      if key is not None:
+        self.__keyed[key] = entry
+      #end if
+
+      self.__stats['queued'] += 1
+      self.__stats['maxDepth'] = max(self.__stats['maxDepth'], self.__depth())
+    #end with
+  #end def (Put)
+
+
+  # The next message to hand to paho, with its place in the window already claimed, or None
+  def Take(self):
+
+    with self.__lock:
+      while len(self.__pending) + self.__reserved < self.window:
+        queue = next((queue for queue in self.__queues if len(queue) > 0), None)
+
+        if queue is None:
+          return None
+        #end if
+
+        entry = queue.popleft()
+        self.__forget(entry)
+
+        if entry['expires'] is not None and entry['expires'] <= time.time():
+          self.__stats['expired'] += 1
+          continue
+        #end if
+
+        self.__reserved += 1
+
+        return entry
+      #end while
+    #end with
+
+    return None
+  #end def (Take)
+
+
+  def GetStats(self):
+
+    with self.__lock:
+      stats = dict(self.__stats)
+      stats['depth']    = self.__depth()
+      stats['inFlight'] = len(self.__pending) + self.__reserved
+    #end with
+
+    return stats
+  #end def (GetStats)
+
+
+  def __depth(self):
+    return sum(len(queue) for queue in self.__queues)
+  #end def (__depth)
+
+
+  # A newer entry may have taken over the key already, see Put()
+  def __forget(self, entry):
+    if entry.get('key') is not None and self.__keyed.get(entry['key']) is entry:
+      del self.__keyed[entry['key']]
+    #end if
+  #end def (__forget)
+
+#end class (OutboundQueue)
+
+
+
+# LatencyMonitor times the CIPO/PING -> PONG round trip. Every heartbeat carries a pingSeq,
+# and a room controller that echoes it back in its PONG ({"pingSeq": n, "serverTime": t}) lets
+# us match the two exactly; a bare PONG is matched to the puzzle's most recent ping instead.
+# We keep a rolling window of round trip times for percentiles, and when the PONG carries the
+# room controller's wall clock we estimate our clock offset from it the NTP way, trusting the
+# sample with the shortest round trip the most.
+#
+# It also counts the pings each puzzle has sent since its last PONG, which is how the
+# connection spots a half-open link long before TCP keepalive would. A puzzle only counts once
+# it has had a PONG on the current session, so a room controller that never answers is left alone.
+class LatencyMonitor:
+
+  def __init__(self, WindowSize = 64):
+    self.__outstanding = collections.OrderedDict()
+    self.__samples = collections.deque(maxlen = WindowSize)
+    self.__sequence = 0
+    self.__lock = threading.Lock()
+
+    self.__lastPongAt = {}
+    self.__unanswered = {}
+
+    self.pongCount = 0
+    self.unmatchedPongCount = 0
+  #end def (__init__)
+
+
+  def PingSent(self, puzzleID, sentAt):
+
+    with self.__lock:
+      self.__sequence += 1
+      self.__outstanding[(puzzleID, self.__sequence)] = (time.monotonic(), sentAt)
+
+      if puzzleID in self.__lastPongAt:
+        self.__unanswered[puzzleID] = self.__unanswered.get(puzzleID, 0) + 1
+      #end if
+
+      # PONGs that never come shouldn't pile up
+      while len(self.__outstanding) > 64:
+        self.__outstanding.popitem(last = False)
+      #end while
+
+      return self.__sequence
+    #end with
+  #end def (PingSent)
+
+
+  def PongReceived(self, puzzleID, payload):
+
+    receivedMonotonic = time.monotonic()
+    receivedAt = time.time()
+
+    pingSeq = None
+    serverTime = None
+
+    try:
+      pong = json.loads(payload.decode())
+
+      if isinstance(pong, dict):
+        pingSeq = pong.get('pingSeq')
+        serverTime = pong.get('serverTime')
+      #end if
+
+    except ValueError:
+      pass
+    #end try
+
+    # Anything that isn't a number is treated as if it wasn't there at all
+    if isinstance(pingSeq, bool) or not isinstance(pingSeq, int):
+      pingSeq = None
+    #end if
+
+    if isinstance(serverTime, bool) or not isinstance(serverTime, (int, float)):
+      serverTime = None
+    #end if
+
+    with self.__lock:
+      if pingSeq is not None:
+        sent = self.__outstanding.pop((puzzleID, pingSeq), None)
+
+      else:
+        matchingKeys = [key for key in self.__outstanding if key[0] == puzzleID]
+        sent = self.__outstanding.pop(matchingKeys[-1]) if len(matchingKeys) > 0 else None
+      #end if
+
+      if sent is None:
+        self.unmatchedPongCount += 1
+        return None
+      #end if
+
+      roundTrip = receivedMonotonic - sent[0]
+
+      offset = None
+
+      if serverTime is not None:
+        offset = serverTime - ((sent[1] + receivedAt) / 2)
+      #end if
+
+      self.__samples.append( (roundTrip, offset) )
+      self.pongCount += 1
+
+      self.__lastPongAt[puzzleID] = receivedMonotonic
+      self.__unanswered[puzzleID] = 0
+    #end with
+
+    return roundTrip
+  #end def (PongReceived)
+
+
+  # Pings the puzzle sent since its last PONG, or 0 if it hasn't had a PONG on this session
+  def GetMissedPongs(self, puzzleID):
+    with self.__lock:
+      return self.__unanswered.get(puzzleID, 0)
+    #end with
+  #end def (GetMissedPongs)
+
+
+  def GetSilence(self, puzzleID):
+    with self.__lock:
+      lastPongAt = self.__lastPongAt.get(puzzleID)
+    #end with
+
+    if lastPongAt is None:
+      return None
+    #end if
+
+    return time.monotonic() - lastPongAt
+  #end def (GetSilence)
+
+
+  # A new session starts with nothing in flight and has to earn its PONGs again
+  def NewSession(self):
+    with self.__lock:
+      self.__outstanding.clear()
+      self.__lastPongAt.clear()
+      self.__unanswered.clear()
+    #end with
+  #end def (NewSession)
+
+
+  def GetClockOffset(self):
+
+    with self.__lock:
+      offsetSamples = [sample for sample in self.__samples if sample[1] is not None]
+    #end with
+
+    if len(offsetSamples) == 0:
+      return None
+    #end if
+
+    return min(offsetSamples)[1]
+  #end def (GetClockOffset)
+
+
+  def GetStats(self):
+
+    with self.__lock:
+      roundTrips = sorted(sample[0] for sample in self.__samples)
+    #end with
+
+    stats = {}
+    stats['samples']   = len(roundTrips)
+    stats['pongs']     = self.pongCount
+    stats['unmatched'] = self.unmatchedPongCount
+
+    for percentile in [50, 95, 99]:
+      if len(roundTrips) > 0:
+        stats['p{}'.format(percentile)] = roundTrips[min(len(roundTrips) - 1, int(len(roundTrips) * percentile / 100))]
+      else:
+        stats['p{}'.format(percentile)] = None
+      #end if
+    #end for
+
+    stats['clockOffset'] = self.GetClockOffset()
+
+    return stats
+  #end def (GetStats)
+
+
+  # The fields we add to the next heartbeat (round trip times in milliseconds)
+  def GetHeartbeatReport(self):
+
+    stats = self.GetStats()
+
+    if stats['samples'] == 0:
+      return {}
+    #end if
+
+    report = {}
+    report['rttP50'] = round(stats['p50'] * 1000, 1)
+    report['rttP95'] = round(stats['p95'] * 1000, 1)
+    report['rttP99'] = round(stats['p99'] * 1000, 1)
+
+    if stats['clockOffset'] is not None:
+      report['clockOffset'] = round(stats['clockOffset'], 4)
+    #end if
+
+    return report
+  #end def (GetHeartbeatReport)
+
+#end class (LatencyMonitor)
+
+
+
+# A ControllerConnection owns the single MQTT client (and its network thread) for a host.
+# Normally every ControllerCommunications object builds a private one behind the scenes, but
+# when one Pi runs several puzzles you can create a ControllerConnection yourself and hand it
+# to each of them. They will then share one socket, one keepalive and one Last Will:
+#
+#   RoomConnection = ControllerConnection('ms-roomcontroller.local')
+#   FuelRoomController  = ControllerCommunications('fuel',  Connection = RoomConnection)
+#   PowerRoomController = ControllerCommunications('power', Connection = RoomConnection)
+#   RoomConnection.connect()
+#
+# When more than one puzzle shares the connection the Last Will is published to
+# CIPO/HOST/<hostID>/STATE with a JSON payload listing every puzzle ID it covers, and every time
+# we connect the same topic is set to 'ONLINE'. Both are retained. The puzzles' own STATE
+# messages are not retained in that case (a will can only clear one topic), so the room
+# controller has to join the two: a puzzle is only as alive as the host it's listed on, and
+# after a restart it learns the puzzles' states by asking for a snapshot (SNAPSHOT_TOPIC).
+class ControllerConnection:
+
+  # JournalPath is where messages queued while offline are kept. It defaults to a file on /dev/shm
+  # (tmpfs, so no SD card wear) named after the puzzles on this connection.
+  #
+  # With PersistentSession (the default) the broker keeps our subscriptions, and any QoS 1
+  # commands sent our way, across reconnects. That needs a client ID that stays the same from one
+  # run to the next, so it's built from the host name and the puzzle IDs when connect() is called.
+  # Bare commands still waiting in the session from an earlier run are dropped as 'stale'.
+  #
+  # MissedPongLimit is how many heartbeats in a row can go without a PONG before we decide the
+  # session is dead and dial in again (None turns that off).
+  #
+  # FallbackBrokers is an optional list of other broker addresses to try, in order, when
+  # mqttBroker can't be reached. ResolverTTL is how long (in seconds) a looked up address is
+  # trusted before it's refreshed in the background.
+  #
+  # With MQTTv5 we speak MQTT v5 to the broker: heartbeats go out under topic aliases and with a
+  # message expiry, and command acks honour the command's response topic and correlation data.
+  # If paho-mqtt is too old for v5, or the broker turns it down, we carry on with 3.1.1.
+  #
+  # With HostHeartbeatInterval set, the host's telemetry (IP and MAC address, temperature,
+  # uptime, platform, round trip times) is published once per Pi, every that many seconds, on
+  # CIPO/HOST/<hostID>/PING together with the list of puzzle IDs it hosts. Each puzzle's own
+  # heartbeat then only says which state it's in and which host it's on, which is what the room
+  # controller joins the two on. Left at None, every puzzle heartbeat is complete as before.
+  #
+  # InboundRate and InboundBurst set how many messages a second (and how many at once) any one
+  # topic may bring in before the rest are dropped, see InboundLimiter.
+  def __init__(self, mqttBroker, mqttPort = 1883, TelemetryInterval = 10, JournalPath = None, PersistentSession = True, MissedPongLimit = 3, FallbackBrokers = None, ResolverTTL = 60, MQTTv5 = False, HostHeartbeatInterval = None, InboundRate = 20, InboundBurst = 40):
+    self.mqttBroker = mqttBroker
+    self.mqttPort = mqttPort
+    self.hostID = socket.gethostname()
+
+    # The broker we're connected to (or trying to), which is mqttBroker unless we've fallen back
+    self.currentBroker = mqttBroker
+    self.resolver = BrokerResolver([mqttBroker] + list(FallbackBrokers or []), TTL = ResolverTTL)
+
+    self.telemetry = HostTelemetry(mqttBroker, SampleInterval = TelemetryInterval, Resolver = self.resolver)
+
+    self.mqttKeepalive = 15
+
+    # How long the broker has to answer our CONNECT before we give up on that attempt
+    self.connackTimeout = 10
+
+    self.reconnect = ReconnectManager()
+    self.scheduler = EventScheduler()
+    self.cueScheduler = EventScheduler(Name = 'rcpcs-cues')
+    self.journal = OutboundJournal()
+    self.journalPath = JournalPath
+    self.router = TopicRouter()
+    self.publishTracker = PublishTracker()
+    self.outbound = OutboundQueue()
+    self.inbound = InboundLimiter(Rate = InboundRate, Burst = InboundBurst)
+    self.latency = LatencyMonitor()
+    self.missedPongLimit = MissedPongLimit
+    self.hostHeartbeatInterval = HostHeartbeatInterval
+
+    self.__puzzles = {}
+    self.__MQTTConnected = False
+    self.__connectStarted = False
+    self.__connectedEvent = threading.Event()
+    self.__networkThread = None
+    self.__publishLock = threading.RLock()
+    self.__extraSubscriptions = []
+    self.__sessionDead = False
+    self.__groups = {}
+    self.__disconnectDeadline = None
+    self.__connackDeadline = None
+    self.__firstConnect = True
+    self.__backlogSubscribeMid = None
+
+    # The highest compact heartbeat schema the room controller has advertised (None means JSON only)
+    self.heartbeatSchema = None
+
+    self.persistentSession = PersistentSession
+
+    self.useMQTTv5 = MQTTv5
+
+    if MQTTv5 is True and Properties is None:
+      print('>> WARNING: this version of paho-mqtt does not support MQTT v5, using 3.1.1 instead')
+      self.useMQTTv5 = False
+    #end if
+
+    # Topic aliases only live as long as one network connection, so they're handed out afresh
+    # every time we connect, up to the limit the broker sets.
+    self.__aliasTopics = set()
+    self.__topicAliases = {}
+    self.__topicAliasMaximum = 0
+    self.__aliasLock = threading.Lock()
+    self.__protocolFallback = False
+    self.__unansweredConnects = 0
+    self.__clientID = ''
+
+    self.mqttClient = mqtt.Client()
+    self.__setClientCallbacks()
+
+    # The room controller can ask every puzzle in the room for its state in one go
+    self.AddRoute(SNAPSHOT_TOPIC, self.__handleSnapshotRequest, Subscribe = True)
+    self.AddRoute(ROOM_COMMAND_TOPIC, self.__handleBroadcastCommand, Subscribe = True, Qos = self.__getCommandQos())
+
+    self.UseTopicAlias('CIPO/HOST/' + self.hostID + '/PING')
+  #end def (__init__)
+
+
+  def __setClientCallbacks(self):
+
+    # v5 hands on_connect and on_disconnect an extra properties argument
+    if self.useMQTTv5 is True:
+      self.mqttClient.on_connect    = self.__handlerMQTTv5onConnect
+      self.mqttClient.on_disconnect = self.__handlerMQTTv5onDisconnect
+    else:
+      self.mqttClient.on_connect    = self.__handlerMQTTonConnect
+      self.mqttClient.on_disconnect = self.__handlerMQTTonDisconnect
+    #end if
+
+    self.mqttClient.on_message    = self.__handlerMQTTonMessage
+    self.mqttClient.on_publish    = self.__handlerMQTTonPublish
+    self.mqttClient.on_subscribe  = self.__handlerMQTTonSubscribe
+
+    self.mqttClient.on_socket_register_write = self.__handlerMQTTonSocketRegisterWrite
+  #end def (__setClientCallbacks)
+
+
+  def Attach(self, puzzle):
+
+    if puzzle.puzzleID in self.__puzzles:
+      raise ValueError('Puzzle ID [{}] is already attached to this connection'.format(puzzle.puzzleID))
+    #end if
+
+    self.__puzzles[puzzle.puzzleID] = puzzle
+
+    if self.__connectStarted is True:
+      print('>> WARNING: Puzzle ID [{}] was attached after connect(), it is not covered by the Last Will'.format(puzzle.puzzleID))
+
+      if self.__MQTTConnected is True:
+        self.mqttClient.subscribe(self.__getSubscriptions([puzzle.puzzleID]))
+      #end if
+    #end if
+  #end def (Attach)
+
+
+  def GetPuzzleIDs(self):
+    return list(self.__puzzles.keys())
+  #end def (GetPuzzleIDs)
+
+
+  # The attached ControllerCommunications object for puzzleID, or None when it's hosted elsewhere
+  def GetPuzzle(self, puzzleID):
+    return self.__puzzles.get(puzzleID)
+  #end def (GetPuzzle)
+
+
+  # Only a puzzle that has the connection (and so the Last Will) to itself retains its STATE
+  def RetainsPuzzleState(self):
+    return len(self.__puzzles) == 1
+  #end def (RetainsPuzzleState)
+
+
+  # QoS 0 messages on this topic go out under a topic alias when we're speaking MQTT v5. QoS 1
+  # and 2 messages never do, as paho would redeliver them after a reconnect under an alias the
+  # new connection doesn't know about.
+  def UseTopicAlias(self, topic):
+    self.__aliasTopics.add(topic)
+  #end def (UseTopicAlias)
+
+
+  # Adds a hosted puzzle to a command group, subscribing to the group's topic the first time
+  def JoinGroup(self, groupName, puzzle):
+
+    if groupName not in self.__groups:
+      self.__groups[groupName] = []
+      self.AddRoute(GROUP_COMMAND_TOPIC.format(groupName), self.__handleBroadcastCommand, Subscribe = True, Qos = self.__getCommandQos())
+    #end if
+
+    if puzzle not in self.__groups[groupName]:
+      self.__groups[groupName].append(puzzle)
+    #end if
+  #end def (JoinGroup)
+
+
+  def GetGroups(self):
+    return dict((groupName, [puzzle.puzzleID for puzzle in members]) for groupName, members in self.__groups.items())
+  #end def (GetGroups)
+
+
+  def IsConnected(self):
+    return self.__MQTTConnected
+  #end def (IsConnected)
+
+
+  # With Blocking = False this returns straight away and the network thread keeps dialing in the
+  # background, so puzzles can be reset and played before the room controller is even up.
+  def connect(self, Blocking = True):
+
+    # Several puzzles sharing this connection may each call connect(), only the first one counts.
+    if self.__connectStarted is True:
+      if Blocking is True:
+        self.__connectedEvent.wait()
+      #end if
+
+      return
+    #end if
+
+    self.__connectStarted = True
+
+    self.resolver.Start()
+    self.telemetry.Start()
+    self.scheduler.Start()
+    self.cueScheduler.Start()
+
+    if self.hostHeartbeatInterval is not None:
+      self.scheduler.CallLater(self.hostHeartbeatInterval, self.__hostHeartbeatTick)
+    #end if
+
+    if self.journalPath is None:
+      journalDirectory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+      self.journalPath = os.path.join(journalDirectory, 'rcpcs-outbound-{}.json'.format('-'.join(sorted(self.GetPuzzleIDs()))))
+    #end if
+
+    self.journal.Open(self.journalPath)
+
+    if self.persistentSession is True:
+      self.__clientID = 'rcpcs-{}-{}'.format(self.hostID, '-'.join(sorted(self.GetPuzzleIDs())))
+    #end if
+
+    if self.useMQTTv5 is True:
+      self.__createClient()
+
+    elif self.persistentSession is True:
+      # reinitialise() keeps the same client object (which the puzzles already hold on to) but wipes its callbacks
+      self.mqttClient.reinitialise(client_id = self.__clientID, clean_session = False)
+      self.__setClientCallbacks()
+      self.publishTracker.NewSession()
+    #end if
+
+    self.__setLastWill()
+
+    self.reconnect.Starting()
+    self.reconnect.Resume()
+
+    self.__networkThread = threading.Thread(target=self.__networkLoop, name='rcpcs-mqtt', daemon=True)
+    self.__networkThread.start()
+
+    if Blocking is True:
+      self.__connectedEvent.wait()
+    #end if
+
+  #end def (connect)
+
+
+  def disconnect(self):
+
+    # Stop the network thread from dialing back in, then say goodbye to the broker
+    self.reconnect.Cancel()
+
+    # From a message handler (a REBOOT command, say) we're still inside paho's on_message, and paho
+    # only queues the PUBACK for that message once we return. Hanging up now would leave the
+    # command in our persistent session, for the broker to hand us again the moment we're back,
+    # so the network thread hangs up once the handler is done instead. That also gives every
+    # puzzle a broadcast REBOOT reaches the chance to say so first.
+    if threading.current_thread() is self.__networkThread:
+      self.__disconnectDeadline = time.monotonic() + 2
+      return
+    #end if
+
+    self.mqttClient.disconnect()
+  #end def (disconnect)
+
+
+  # Publishes right away when we're connected, otherwise the message goes to the journal. Messages
+  # with the same CoalesceKey replace each other while they wait, and a TimeToLive (in seconds)
+  # lets them expire rather than be replayed late (under MQTT v5 it also becomes the message
+  # expiry, so the broker drops it rather than deliver it late). CorrelationData is only sent
+  # under MQTT v5.
+  #
+  # While we're connected, messages go through the OutboundQueue. Priority is one of its
+  # PRIORITY_ values and is normally worked out from the topic. The MessageInfo is only handed
+  # back when the message went straight to paho, which STATE and ACK messages always do.
+  def Publish(self, topic, payload, qos = 0, retain = False, CoalesceKey = None, TimeToLive = None, CorrelationData = None, Priority = None):
+
+    with self.__publishLock:
+      if self.__MQTTConnected is True:
+        messageInfo = self.__submit(topic, payload, qos, retain, CoalesceKey, TimeToLive, CorrelationData, Priority)
+
+      else:
+        self.journal.Put(topic, payload, qos=qos, retain=retain, Key=CoalesceKey, TimeToLive=TimeToLive, CorrelationData=CorrelationData)
+        return None
+      #end if
+    #end with
+
+    self.__pumpOutbound()
+
+    return messageInfo
+  #end def (Publish)
+
+
+  def GetQueueStats(self):
+    return self.outbound.GetStats()
+  #end def (GetQueueStats)
+
+
+  def GetInboundStats(self):
+    return self.inbound.GetStats()
+  #end def (GetInboundStats)
+
+
+  def __submit(self, topic, payload, qos, retain, CoalesceKey, TimeToLive, CorrelationData, Priority):
+
+    if Priority is None:
+      Priority = self.outbound.Classify(topic)
+    #end if
+
+    if self.outbound.Admit(Priority) is False:
+      return None
+    #end if
+
+    if self.outbound.Reserve(Force = Priority == OutboundQueue.PRIORITY_CRITICAL) is True:
+      return self.__handToClient(topic, payload, qos, retain, TimeToLive, CorrelationData)
+    #end if
+
+    entry = {}
+    entry['key']         = CoalesceKey
+    entry['topic']       = topic
+    entry['payload']     = payload
+    entry['qos']         = qos
+    entry['retain']      = retain
+    entry['expires']     = None if TimeToLive is None else time.time() + TimeToLive
+    entry['correlation'] = CorrelationData
+    entry['priority']    = Priority
+
+    self.outbound.Put(entry)
+
+    return None
+  #end def (__submit)
+
+
+  # Settles the place in the window that was reserved for this message
+  def __handToClient(self, topic, payload, qos, retain, TimeToLive, CorrelationData):
+
+    if qos > 0:
+      self.publishTracker.Reserve()
+    #end if
+
+    try:
+      messageInfo = self.__publishNow(topic, payload, qos, retain, TimeToLive = TimeToLive, CorrelationData = CorrelationData)
+
+    except Exception:
+      self.outbound.Release()
+
+      if qos > 0:
+        self.publishTracker.Release()
+      #end if
+
+      raise
+    #end try
+
+    if messageInfo.rc == mqtt.MQTT_ERR_SUCCESS:
+      self.outbound.Sent(messageInfo.mid)
+    else:
+      self.outbound.Release()
+    #end if
+
+    if qos > 0 and messageInfo.rc == mqtt.MQTT_ERR_SUCCESS:
+      self.publishTracker.Track(messageInfo, topic)
+    elif qos > 0:
+      self.publishTracker.Release()
+    #end if
+
+    return messageInfo
+  #end def (__handToClient)
+
+
+  # Moves waiting messages on to paho as the window opens up. It never holds __publishLock, since
+  # it runs from on_publish on the network thread.
+  def __pumpOutbound(self):
+
+    while self.__MQTTConnected is True:
+      entry = self.outbound.Take()
+
+      if entry is None:
+        break
+      #end if
+
+      timeToLive = None if entry['expires'] is None else entry['expires'] - time.time()
+      self.__handToClient(entry['topic'], entry['payload'], entry['qos'], entry['retain'], timeToLive, entry['correlation'])
+    #end while
+
+  #end def (__pumpOutbound)
+
+
+  # Blocks until the broker has acknowledged a QoS 1/2 message, or until timeout seconds pass.
+  # It must never be called from the network thread, since that's the thread that reads the ack.
+  def WaitForPublish(self, messageInfo, timeout):
+
+    # paho turned it down (we weren't connected after all, say), so it never left the Pi
+    if messageInfo is None or messageInfo.rc != mqtt.MQTT_ERR_SUCCESS:
+      return False
+    #end if
+
+    if threading.current_thread() is self.__networkThread:
+      print('>> WARNING: cannot wait for a publish acknowledgement on the MQTT network thread')
+      return False
+    #end if
+
+    return self.publishTracker.WaitForAck(messageInfo.mid, timeout)
+  #end def (WaitForPublish)
+
+
+  def GetPublishStats(self):
+    return self.publishTracker.GetStats()
+  #end def (GetPublishStats)
+
+
+  def __publishNow(self, topic, payload, qos, retain, TimeToLive = None, CorrelationData = None):
+
+    if self.useMQTTv5 is True:
+      properties = Properties(PacketTypes.PUBLISH)
+
+      if TimeToLive is not None:
+        properties.MessageExpiryInterval = max(1, int(math.ceil(TimeToLive)))
+      #end if
+
+      if CorrelationData is not None:
+        properties.CorrelationData = CorrelationData
+      #end if
+
+      publishTopic = topic
+
+      if qos == 0 and topic in self.__aliasTopics:
+        publishTopic = self.__aliasTopic(topic, properties)
+      #end if
+
+      messageInfo = self.mqttClient.publish(publishTopic, payload, qos=qos, retain=retain, properties=properties)
+
+    else:
+      messageInfo = self.mqttClient.publish(topic, payload, qos=qos, retain=retain)
+    #end if
+
+    return messageInfo
+  #end def (__publishNow)
+
+
+  # The first message on a topic sets up its alias, after that the topic name itself is left out
+  def __aliasTopic(self, topic, properties):
+
+    with self.__aliasLock:
+      alias = self.__topicAliases.get(topic)
+
+      if alias is not None:
+        properties.TopicAlias = alias
+        return ''
+      #end if
+
+      if len(self.__topicAliases) < self.__topicAliasMaximum:
+        alias = len(self.__topicAliases) + 1
+        self.__topicAliases[topic] = alias
+        properties.TopicAlias = alias
+      #end if
+    #end with
+
+    return topic
+  #end def (__aliasTopic)
+
+
+  # Swaps in a brand new paho client. reinitialise() can't change the protocol version, so for
+  # MQTT v5 (and when falling back from it) the puzzles are pointed at the new client instead.
+  def __createClient(self):
+
+    if self.useMQTTv5 is True:
+      self.mqttClient = mqtt.Client(client_id = self.__clientID, protocol = mqtt.MQTTv5)
+    else:
+      self.mqttClient = mqtt.Client(client_id = self.__clientID, clean_session = not self.persistentSession)
+    #end if
+
+    self.__setClientCallbacks()
+    self.publishTracker.NewSession()
+
+    for puzzle in list(self.__puzzles.values()):
+      puzzle.mqttClient = self.mqttClient
+    #end for
+  #end def (__createClient)
+
+
+  # Routes a topic pattern to handler(message, topicSegments). Anything under COPI/<puzzleID>/ or
+  # POPI/<puzzleID>/ for a hosted puzzle is already subscribed, for any other topic pass
+  # Subscribe = True and it will be subscribed (at QoS Qos) now and on every reconnect.
+  def AddRoute(self, pattern, handler, Subscribe = False, Qos = 0):
+
+    self.router.AddRoute(pattern, handler)
+
+    if Subscribe is True and pattern not in [subscription[0] for subscription in self.__extraSubscriptions]:
+      self.__extraSubscriptions.append( (pattern, Qos) )
+
+      if self.__MQTTConnected is True:
+        self.mqttClient.subscribe(pattern, Qos)
+      #end if
+    #end if
+  #end def (AddRoute)
+
+
+  def _HandleHeartbeatSchema(self, message, topicSegments):
+
+    try:
+      advertisedSchema = json.loads(message.payload.decode())
+
+      if isinstance(advertisedSchema, dict):
+        advertisedSchema = advertisedSchema.get('schema')
+      #end if
+
+      self.heartbeatSchema = None if advertisedSchema is None else int(advertisedSchema)
+
+    except ValueError:
+      self.heartbeatSchema = None
+    #end try
+
+    print('>> Room controller heartbeat schema: [{}]'.format(self.heartbeatSchema))
+  #end def (_HandleHeartbeatSchema)
+
+
+  def GetReconnectStats(self):
+    return self.reconnect.GetStats()
+  #end def (GetReconnectStats)
+
+
+  # Called by each puzzle before it sends a heartbeat. Once a puzzle has missed missedPongLimit
+  # PONGs in a row we stop publishing (so everything from here on goes to the journal) and leave
+  # the network thread to reconnect. Returns False when the session has been declared dead.
+  def _CheckLiveness(self, puzzleID):
+
+    if not self.missedPongLimit or self.latency.GetMissedPongs(puzzleID) < self.missedPongLimit:
+      return True
+    #end if
+
+    silence = self.latency.GetSilence(puzzleID)
+
+    with self.__publishLock:
+      if self.__MQTTConnected is False:
+        return False
+      #end if
+
+      self.__MQTTConnected = False
+      self.__connectedEvent.clear()
+    #end with
+
+    print('>> No PONG from MQTT Broker [{}:{}] for {:.1f} seconds, reconnecting..'.format(self.currentBroker, self.mqttPort, silence) )
+    self.latency.NewSession()
+    self.reconnect.SessionDead(silence)
+    self.__sessionDead = True
+
+    return False
+  #end def (_CheckLiveness)
+
+
+  def SendHostPing(self):
+
+    if self.__MQTTConnected is False:
+      return
+    #end if
+
+    data = self.telemetry.Snapshot()
+    data['timestamp'] = time.time()
+    data['hostID']    = self.hostID
+    data['role']      = 'host'
+    data['puzzleIDs'] = self.GetPuzzleIDs()
+
+    data.update(self.latency.GetHeartbeatReport())
+
+    hostPingTopic = 'CIPO/HOST/' + self.hostID + '/PING'
+
+    self.Publish(hostPingTopic, json.dumps(data), CoalesceKey=hostPingTopic, TimeToLive=self.hostHeartbeatInterval * 2)
+  #end def (SendHostPing)
+
+
+  def __hostHeartbeatTick(self):
+
+    try:
+      self.SendHostPing()
+    finally:
+      self.scheduler.CallLater(self.hostHeartbeatInterval, self.__hostHeartbeatTick)
+    #end try
+  #end def (__hostHeartbeatTick)
+
+
+  def GetResolverStats(self):
+    return self.resolver.GetStats()
+  #end def (GetResolverStats)
+
+
+  def GetLatencyStats(self):
+    return self.latency.GetStats()
+  #end def (GetLatencyStats)
+
+
+  # True while the broker may still be handing us messages it kept in our session from before this
+  # program started, see __handlerMQTTonConnect
+  def _IsSessionBacklog(self):
+    return self.__backlogSubscribeMid is not None
+  #end def (_IsSessionBacklog)
+
+
+  # This is the only thread that ever touches the socket. While we're connected it services
+  # paho, and while we're not it works through the ReconnectManager's schedule. Nothing in
+  # here (or in any paho callback) ever sleeps, so commands flow the moment the broker is back.
+  def __networkLoop(self):
+
+    linkUp = False
+
+    while True:
+
+      # connect() throws the old socket away, which is all a half-open link needs
+      if linkUp is True and self.__sessionDead is True:
+        self.__sessionDead = False
+        linkUp = False
+        continue
+      #end if
+
+      # The socket opened but the broker never answered our CONNECT (or hung up without doing so).
+      # That's a failed attempt like any other, so it backs off and moves on to the next broker.
+      # connect() throws this socket away, and keeps whatever paho still has to resend.
+      if linkUp is True and self.__connackDeadline is not None and time.monotonic() > self.__connackDeadline:
+        print('>> MQTT Broker [{}:{}] did not answer within {} seconds'.format(self.currentBroker, self.mqttPort, self.connackTimeout) )
+        self.__connectUnanswered('no CONNACK within {} seconds'.format(self.connackTimeout))
+        linkUp = False
+        continue
+      #end if
+
+      if linkUp is True:
+        try:
+          rc = self.mqttClient.loop(timeout = 0.5)
+
+        except Exception as e:
+          # paho hands on anything our callbacks raise. The link itself is fine, so carry on.
+          print('>> MQTT network loop raised an exception: [{}]'.format(e))
+          rc = mqtt.MQTT_ERR_SUCCESS
+        #end try
+
+        # disconnect() was called from a message handler. Its PUBACK has gone out by now, and we give
+        # the broker a moment to take what we said on the way out (a REBOOTING STATE, say) too.
+        if self.__disconnectDeadline is not None:
+          if self.publishTracker.GetStats()['inFlight'] == 0 or time.monotonic() > self.__disconnectDeadline:
+            self.__disconnectDeadline = None
+            self.mqttClient.disconnect()
+          #end if
+        #end if
+
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+          linkUp = False
+
+          if self.__connackDeadline is not None:
+            self.__connectUnanswered('connection closed before CONNACK [{}]'.format(rc))
+
+          elif not self.reconnect.IsCancelled():
+            self.reconnect.Disconnected('network loop returned [{}]'.format(rc))
+          #end if
+        #end if
+
+        continue
+      #end if
+
+      if self.reconnect.IsCancelled():
+        break
+      #end if
+
+      if self.__protocolFallback is True:
+        self.__protocolFallback = False
+        self.useMQTTv5 = False
+        self.__createClient()
+        self.__setLastWill()
+      #end if
+
+      delay = self.reconnect.NextDelay()
+
+      if delay > 0:
+        print('>> Unable to connect to MQTT broker! Retrying in {:.2f} seconds..'.format(delay) )
+      #end if
+
+      if self.reconnect.Wait(delay) is True:
+        break
+      #end if
+
+      try:
+        self.currentBroker = self.resolver.GetBroker(self.reconnect.attemptCount)
+        brokerAddress = self.resolver.GetAddress(self.currentBroker)
+
+        if brokerAddress is None:
+          raise socket.gaierror('unable to resolve {}'.format(self.currentBroker))
+        #end if
+
+        print(">> Attempting MQTT broker connection to [{}]..".format(self.currentBroker))
+        if self.useMQTTv5 is True:
+          self.mqttClient.connect(brokerAddress, self.mqttPort, self.mqttKeepalive, clean_start = not self.persistentSession, properties = self.__getConnectProperties())
+        else:
+          self.mqttClient.connect(brokerAddress, self.mqttPort, self.mqttKeepalive)
+        #end if
+
+        self.__connackDeadline = time.monotonic() + self.connackTimeout
+        linkUp = True
+
+      except Exception as e:
+        self.reconnect.AttemptFailed(e)
+      #end try
+
+    #end while
+
+  #end def (__networkLoop)
+
+
+  # Some brokers that only speak 3.1.1 don't refuse a v5 CONNECT, they just hang up on it (or
+  # never answer). A few of those in a row and the network thread tries 3.1.1 instead.
+  def __connectUnanswered(self, reason):
+    self.__connackDeadline = None
+    self.reconnect.AttemptFailed(reason)
+
+    if self.useMQTTv5 is True:
+      self.__unansweredConnects += 1
+
+      if self.__unansweredConnects >= 3:
+        print('>> MQTT Broker [{}:{}] never answered MQTT v5, falling back to 3.1.1'.format(self.currentBroker, self.mqttPort) )
+        self.__unansweredConnects = 0
+        self.__protocolFallback = True
+      #end if
+    #end if
+  #end def (__connectUnanswered)
+
+
+  def __handleSnapshotRequest(self, message, topicSegments):
+    for puzzle in list(self.__puzzles.values()):
+      puzzle._AnswerSnapshot()
+    #end for
+
+    if self.hostHeartbeatInterval is not None:
+      self.SendHostPing()
+    #end if
+  #end def (__handleSnapshotRequest)
+
+
+  def __setLastWill(self):
+
+    puzzleIDs = self.GetPuzzleIDs()
+
+    # A lone puzzle keeps the will it always had, so existing room controllers see no difference.
+    # It's retained, like its STATE, so a dead puzzle doesn't leave a stale state behind. A shared
+    # connection doesn't retain its puzzles' STATE at all, see RetainsPuzzleState().
+    if len(puzzleIDs) == 1:
+      self.mqttClient.will_set('CIPO/' + puzzleIDs[0] + '/STATE', payload='UNKNOWN', qos=1, retain=True)
+
+    else:
+      self.mqttClient.will_set('CIPO/HOST/' + self.hostID + '/STATE', payload=self.__getHostState('UNKNOWN'), qos=1, retain=True)
+    #end if
+  #end def (__setLastWill)
+
+
+  def __getHostState(self, state):
+    hostState = {}
+    hostState['state']     = state
+    hostState['hostID']    = self.hostID
+    hostState['puzzleIDs'] = self.GetPuzzleIDs()
+
+    return json.dumps(hostState)
+  #end def (__getHostState)
+
+
+  # A v5 session ends with the connection unless we ask for it to be kept. A day covers any outage
+  # we'd still want our queued commands from.
+  def __getConnectProperties(self):
+    properties = Properties(PacketTypes.CONNECT)
+
+    if self.persistentSession is True:
+      properties.SessionExpiryInterval = 86400
+    #end if
+
+    return properties
+  #end def (__getConnectProperties)
+
+
+  # In a persistent session QoS 1 lets the broker hold on to commands sent while we're reconnecting
+  def __getCommandQos(self):
+    return 1 if self.persistentSession is True else 0
+  #end def (__getCommandQos)
+
+
+  def __getSubscriptions(self, puzzleIDs):
+    subscriptions = []
+
+    commandQos = self.__getCommandQos()
+
+    for puzzleID in puzzleIDs:
+      subscriptions.append( ('COPI/' + puzzleID + '/#', commandQos) )    # Subscribe to Controller-Out-Puzzle-In
+      subscriptions.append( ('POPI/' + puzzleID + '/#', commandQos) )    # Subscribe to Puzzle-Out-Puzzle-In topic
+    #end for
+
+    subscriptions.extend(self.__extraSubscriptions)
+
+    return subscriptions
+  #end def (__getSubscriptions)
+
+
+  # COPI/ALL/COMMANDS goes to every hosted puzzle, COPI/GROUP/<name>/COMMANDS to the group's members
+  def __handleBroadcastCommand(self, message, topicSegments):
+
+    if topicSegments[1] == 'GROUP':
+      puzzles = list(self.__groups.get(topicSegments[2], []))
+    else:
+      puzzles = list(self.__puzzles.values())
+    #end if
+
+    # A broadcast REBOOT doesn't hang up until every puzzle has had it, see disconnect()
+    for puzzle in puzzles:
+      puzzle._HandleCommand(message, topicSegments)
+    #end for
+  #end def (__handleBroadcastCommand)
+
+
+  # A command the InboundLimiter turned away is still answered, by every puzzle it was meant for,
+  # so the room controller isn't left waiting on an ACK that will never come
+  def __rejectCommand(self, message, reason):
+
+    topicSegments = message.topic.split('/')
+
+    if len(topicSegments) < 3 or topicSegments[0] not in ['COPI', 'POPI'] or topicSegments[-1] != 'COMMANDS':
+      return
+    #end if
+
+    if message.topic == ROOM_COMMAND_TOPIC:
+      puzzles = list(self.__puzzles.values())
+    elif topicSegments[1] == 'GROUP' and len(topicSegments) == 4:
+      puzzles = list(self.__groups.get(topicSegments[2], []))
+    elif len(topicSegments) == 3 and topicSegments[1] in self.__puzzles:
+      puzzles = [self.__puzzles[topicSegments[1]]]
+    else:
+      puzzles = []
+    #end if
+
+    for puzzle in puzzles:
+      puzzle._RejectCommand(message, reason)
+    #end for
+  #end def (__rejectCommand)
+
+
+  def __handlerMQTTonConnect(self, client, userdata, flags, rc):
+
+    self.__connackDeadline = None
+    self.__unansweredConnects = 0
+
+    if rc != 0:
+      print('>> MQTT Broker [{}:{}] refused the connection: [{}]'.format(self.currentBroker, self.mqttPort, mqtt.connack_string(rc)) )
+      self.reconnect.AttemptFailed(mqtt.connack_string(rc))
+
+      # 1 (or 132 under v5) is "unacceptable protocol version", the network thread will retry with 3.1.1
+      if self.useMQTTv5 is True and rc in [1, 132]:
+        print('>> MQTT Broker [{}:{}] does not support MQTT v5, falling back to 3.1.1'.format(self.currentBroker, self.mqttPort) )
+        self.__protocolFallback = True
+      #end if
+
+      return
+    #end if
+
+    print('>> Puzzle ID(s) {} successfully connected to MQTT Broker [{}:{}]..'.format(self.GetPuzzleIDs(), self.currentBroker, self.mqttPort) )
+
+    self.reconnect.Connected()
+    self.latency.NewSession()
+
+    # One SUBSCRIBE packet covers every puzzle hosted on this connection. It goes out even when
+    # the broker kept our session, since that session may date from a build (or a group list)
+    # that didn't have every topic we want now, and subscribing again does no harm.
+    result, subscribeMid = self.mqttClient.subscribe(self.__getSubscriptions(self.GetPuzzleIDs()))
+
+    # The first time we connect, a session the broker kept for us can still hold commands sent
+    # before this program started (while the Pi was rebooting, say). Enveloped commands carry
+    # their age, bare ones don't, so every bare command that turns up before the broker has
+    # answered this SUBSCRIBE is taken to be one of those and dropped.
+    if self.__firstConnect is True and self.persistentSession is True and flags.get('session present'):
+      self.__backlogSubscribeMid = subscribeMid
+    #end if
+
+    self.__firstConnect = False
+
+    # Every puzzle's current state goes through the journal too, so it coalesces with anything
+    # queued offline and each puzzle costs exactly one STATE message on reconnect.
+    with self.__publishLock:
+      for puzzle in list(self.__puzzles.values()):
+        puzzle._QueueState()
+      #end for
+
+      backlog = self.journal.Drain()
+
+      self.outbound.NewSession()
+
+      # Tell the room controller the host is back
+      if self.RetainsPuzzleState() is False:
+        self.__submit('CIPO/HOST/' + self.hostID + '/STATE', self.__getHostState('ONLINE'), 1, True, None, None, None, OutboundQueue.PRIORITY_CRITICAL)
+      #end if
+
+      for entry in backlog:
+        timeToLive = None if entry['expires'] is None else entry['expires'] - time.time()
+        self.__submit(entry['topic'], entry['payload'], entry['qos'], entry['retain'], entry['key'], timeToLive, entry.get('correlation'), None)
+      #end for
+
+      self.__MQTTConnected = True
+    #end with
+
+    self.__pumpOutbound()
+
+    if len(backlog) > 0:
+      print('>> Sent {} queued message(s) to MQTT Broker [{}:{}]'.format(len(backlog), self.currentBroker, self.mqttPort) )
+    #end if
+
+    for puzzle in list(self.__puzzles.values()):
+      puzzle._OnConnected()
+    #end for
+
+    if self.hostHeartbeatInterval is not None:
+      self.SendHostPing()
+    #end if
+
+    self.__connectedEvent.set()
+  #end def (__handlerMQTTonConnect)
+
+
+  # This runs on the network thread, so it only records what happened. Reconnecting is
+  # left to __networkLoop.
+  def __handlerMQTTonDisconnect(self, client, userdata, rc):
+
+    self.__MQTTConnected = False
+    self.__connectedEvent.clear()
+    self.__backlogSubscribeMid = None
+
+    rebootingPuzzles = [puzzle for puzzle in list(self.__puzzles.values()) if puzzle.GetPuzzleState() == 'REBOOTING']
+
+    if len(rebootingPuzzles) > 0:
+      self.reconnect.Cancel()
+
+      for puzzle in rebootingPuzzles:
+        puzzle._SubmitCallback('command_reboot')
+      #end for
+
+    elif rc != 0:
+      print('>> Lost connection to MQTT Broker [{}:{}]: [{}]'.format(self.currentBroker, self.mqttPort, mqtt.error_string(rc)) )
+      self.reconnect.Disconnected(mqtt.error_string(rc))
+    #end if
+
+  #end def (__handlerMQTTonDisconnect)
+
+
+  def __handlerMQTTv5onConnect(self, client, userdata, flags, reasonCode, properties = None):
+
+    self.__topicAliases = {}
+    self.__topicAliasMaximum = getattr(properties, 'TopicAliasMaximum', 0) or 0
+
+    self.__handlerMQTTonConnect(client, userdata, flags, getattr(reasonCode, 'value', reasonCode))
+  #end def (__handlerMQTTv5onConnect)
+
+
+  def __handlerMQTTv5onDisconnect(self, client, userdata, reasonCode, properties = None):
+    self.__handlerMQTTonDisconnect(client, userdata, getattr(reasonCode, 'value', reasonCode))
+  #end def (__handlerMQTTv5onDisconnect)
+
+
+  def __handlerMQTTonPublish(self, client, userdata, mid):
+    self.publishTracker.Acknowledged(mid)
+    self.outbound.Acknowledged(mid)
+
+    self.__pumpOutbound()
+  #end def (__handlerMQTTonPublish)
+
+
+  # Since we run paho's loop ourselves, paho would write to the socket from whichever thread
+  # called publish(), alongside the network thread and with nothing to keep their packets apart.
+  # Just having this callback makes it queue the packet and wake loop() up to send it instead.
+  def __handlerMQTTonSocketRegisterWrite(self, client, userdata, sock):
+    pass
+  #end def (__handlerMQTTonSocketRegisterWrite)
+
+
+  # v5 hands over reason codes and properties instead of the granted QoS, which we don't look at
+  def __handlerMQTTonSubscribe(self, client, userdata, mid, grantedQos, properties = None):
+    if mid == self.__backlogSubscribeMid:
+      self.__backlogSubscribeMid = None
+    #end if
+  #end def (__handlerMQTTonSubscribe)
+
+
+  def __handlerMQTTonMessage(self, client, userdata, message):
+
+    # A handler that chokes on a malformed payload must not take the network thread down with it
+    try:
+      dropReason = self.inbound.Check(message.topic, message.payload)
+
+      if dropReason == 'rate_limited':
+        self.__rejectCommand(message, dropReason)
+      #end if
+
+      if dropReason is not None:
+        return
+      #end if
+
+      self.router.Dispatch(message)
+
+    except Exception as e:
+      print('>> Handling a message on [{}] raised an exception: [{}]'.format(message.topic, e))
+    #end try
+  #end def (__handlerMQTTonMessage)
+
+#end class (ControllerConnection)
+
+
+
+class ControllerCommunications:
+
+  # Bare COPI commands and the callback each one fires. REBOOT, PONG and KEYFRAME are handled
+  # on their own since they involve more than a callback.
+  COMMAND_CALLBACKS = { 'RESET'    : 'command_reset',
+                        'ACTIVATE' : 'command_activate',
+                        'SOLVE'    : 'command_solve',
+                        'FAIL'     : 'command_fail' }
+
+  # With AutoHeartbeat enabled (the default) heartbeats are sent from the connection's scheduler
+  # every few seconds and right after every state change, so calling ProcessEvents() is optional.
+  #
+  # HeartbeatEncoding picks the CIPO/PING payload format: 'json' (the default, understood by every
+  # room controller), 'binary' (always send the compact schema) or 'auto' (send the compact schema
+  # once the room controller advertises it on HEARTBEAT_SCHEMA_TOPIC, JSON until then).
+  #
+  # With HeartbeatKeyframeInterval set to N, heartbeats carry a sequence number and only every Nth
+  # one (plus the first after connecting, and any asked for with a KEYFRAME command) is complete;
+  # the rest only hold the fields that changed. The consumer needs a HeartbeatAssembler for this,
+  # so it is off (None) by default.
+  #
+  # HeartbeatPolicy maps a puzzle state to the heartbeat interval (in seconds) to use while the
+  # puzzle is in it, see ADAPTIVE_HEARTBEAT_POLICY. States that aren't listed fall back to the
+  # None entry, or to the usual 3 seconds. Every state change sends a heartbeat straight away.
+  #
+  # MaxCommandAge is how old (in seconds) an enveloped command can be before it's dropped instead
+  # of run, see EncodeCommand(). None means never. MaxCommandHold is how far ahead (in seconds) an
+  # executeAt may be; a command cued for later than that is turned away. Commands that are being
+  # held are cancelled when a RESET or REBOOT comes in.
+  #
+  # With CommandAcks on, every command is answered on CIPO/<puzzleID>/ACK with a JSON object
+  # saying when it was received, when its callback started and finished (all wall clock), and
+  # how it turned out: 'ok', 'error: ...', 'unhandled' (no callback registered), 'dropped' (the
+  # callback queue was full), 'unknown', 'duplicate', 'stale', 'too_far_ahead', 'cancelled',
+  # 'rate_limited' (too many came in at once, see InboundLimiter) or 'rebooting'. The command's ID
+  # is echoed back when it had one. A command with an executeAt also gets 'late', how many
+  # seconds after that moment its callback actually started.
+  #
+  # Every puzzle also takes commands from ROOM_COMMAND_TOPIC, and from the topic of each command
+  # group named in Groups (see GROUP_COMMAND_TOPIC).
+  #
+  # FallbackBrokers and MQTTv5 are handed to the private connection, see ControllerConnection.
+  def __init__(self, puzzleID, mqttBroker = None, mqttPort = 1883, Connection = None, AutoHeartbeat = True, HeartbeatEncoding = 'json', HeartbeatKeyframeInterval = None, HeartbeatPolicy = None, FallbackBrokers = None, MaxCommandAge = 30, MaxCommandHold = 10, CommandAcks = True, Groups = None, MQTTv5 = False):
+
+    if HeartbeatEncoding not in ['json', 'binary', 'auto']:
+      raise ValueError('Unknown heartbeat encoding [{}]'.format(HeartbeatEncoding))
+    #end if
+
+    # Without a shared connection we quietly build a private one, which behaves exactly like earlier versions did
+    if Connection is None:
+      Connection = ControllerConnection(mqttBroker, mqttPort, FallbackBrokers = FallbackBrokers, MQTTv5 = MQTTv5)
+    #end if
+
+    self.__connection = Connection
+
+    self.mqttBroker = Connection.mqttBroker
+    self.mqttPort = Connection.mqttPort
+    self.mqttClient = Connection.mqttClient
+    self.puzzleID = puzzleID
+
+    self.mqttKeepalive = Connection.mqttKeepalive
+
+    self.__pingDelay = 3
+    self.__heartbeatPolicy = HeartbeatPolicy
+    self.__pingJitter = 0.1
+    self.__timestampLastPing = time.time()
+    self.__autoHeartbeat = AutoHeartbeat
+    self.__heartbeatEncoding = HeartbeatEncoding
+    self.__keyframeInterval = HeartbeatKeyframeInterval
+    self.__heartbeatSequence = 0
+    self.__beatsSinceKeyframe = 0
+    self.__lastHeartbeat = None
+    self.__sequenceLock = threading.Lock()
+    self.__heartbeatJob = None
+    self.__heartbeatLock = threading.Lock()
+    self.__puzzleState = None
+    self.__callbacks = {}
+
+    # Callbacks triggered by incoming messages run here, never on the MQTT network thread
+    self.__executor = CallbackExecutor(puzzleID)
+    self.__commandFilter = CommandFilter(MaxAge = MaxCommandAge)
+    self.__commandAcks = CommandAcks
+    self.__maxCommandHold = MaxCommandHold
+    self.__heldCommands = {}
+    self.__heldSequence = 0
+    self.__heldLock = threading.Lock()
+    self.__peerEventHandlers = {}
+
+    # Unknown topics are answered with an ERROR (and our STATE), but only so often
+    self.__errorReplies = TokenBucket(1, 5)
+    self.__suppressedErrors = 0
+    self.__suppressedErrorsTotal = 0
+
+    # So are commands turned away before they got to us, see _RejectCommand()
+    self.__rejectReplies = TokenBucket(1, 5)
+    self.__suppressedRejectsTotal = 0
+
+    Connection.Attach(self)
+
+    Connection.AddRoute('COPI/' + puzzleID + '/COMMANDS', self._HandleCommand)
+    Connection.AddRoute('POPI/' + puzzleID + '/COMMANDS', self._HandleCommand)
+    Connection.AddRoute('COPI/' + puzzleID + '/PONG',     self._HandlePong)
+    Connection.AddRoute('POPI/' + puzzleID + '/EVENT/+',  self._HandlePeerEvent)
+    Connection.AddRoute('COPI/' + puzzleID + '/#',        self._HandleUnknownTopic)
+    Connection.AddRoute('POPI/' + puzzleID + '/#',        self._HandleUnknownTopic)
+
+    Connection.UseTopicAlias('CIPO/PING/' + puzzleID)
+
+    if HeartbeatEncoding == 'auto':
+      Connection.AddRoute(HEARTBEAT_SCHEMA_TOPIC, Connection._HandleHeartbeatSchema, Subscribe = True)
+    #end if
+
+    for groupName in (Groups or []):
+      Connection.JoinGroup(groupName, self)
+    #end for
+  #end def (__init__)
+
+
+  def connect(self, Blocking = True):
+    self.__connection.mqttKeepalive = self.mqttKeepalive
+    self.__connection.connect(Blocking = Blocking)
+  #end def (connect)
+
+
+  def disconnect(self):
+    self.__connection.disconnect()
+  #end def (disconnect)
+
+
+  def GetConnection(self):
+    return self.__connection
+  #end def (GetConnection)
+
+
+  def GetPuzzleState(self):
+    return self.__puzzleState
+  #end def (GetPuzzleState)
+
+
+  def _OnConnected(self):
+    # Whoever is listening may have missed anything we sent before, so start them off with a keyframe
+    self.__lastHeartbeat = None
+
+    self.SendPing()
+  #end def (_OnConnected)
+
+
+  # Called by the connection (with its publish lock held) just before it drains the journal
+  def _QueueState(self):
+    if self.__puzzleState is not None:
+      stateTopic = 'CIPO/' + self.puzzleID + '/STATE'
+      self.__connection.journal.Put(stateTopic, self.__puzzleState, qos=1, retain=self.__connection.RetainsPuzzleState(), Key=stateTopic)
+    #end if
+  #end def (_QueueState)
+
+
+  # Answers a room-wide SNAPSHOT request straight from what we already know
+  def _AnswerSnapshot(self):
+    self.PublishState(self.__puzzleState)
+
+    self.__lastHeartbeat = None
+    self.SendPing()
+  #end def (_AnswerSnapshot)
+
+
+  # Returns False when the callback wasn't queued (or there's none registered for eventName). An
+  # Urgent callback goes ahead of the ones already waiting, see CallbackExecutor.
+  def _SubmitCallback(self, eventName, Done = None, Urgent = False):
+    if eventName in self.__callbacks:
+      return self.__executor.Submit(self.__callbacks[eventName], Done = Done, Urgent = Urgent)
+    #end if
+
+    return False
+  #end def (_SubmitCallback)
+
+
+  def GetCallbackStats(self):
+    return self.__executor.GetStats()
+  #end def (GetCallbackStats)
+
+
+  def GetCommandStats(self):
+    stats = self.__commandFilter.GetStats()
+    stats['errorsSuppressed']  = self.__suppressedErrorsTotal
+    stats['rejectsSuppressed'] = self.__suppressedRejectsTotal
+
+    return stats
+  #end def (GetCommandStats)
+
+
+  def _HandleCommand(self, message, topicSegments):
+
+    receivedAt = time.monotonic()
+    incomingCommand, commandID, issued, executeAt = DecodeCommand(message.payload)
+
+    clockOffset = self.__connection.latency.GetClockOffset()
+
+    # A bare command the broker kept for us from before we started can't say how old it is
+    if commandID is None and issued is None and self.__connection._IsSessionBacklog() is True:
+      self.__commandFilter.staleCount += 1
+      dropReason = 'stale'
+    else:
+      dropReason = self.__commandFilter.Check(commandID, issued, ClockOffset = clockOffset)
+    #end if
+
+    if dropReason is not None:
+      print(' -> Dropped {} MQTT command: [{}] ({}) for puzzle ID [{}]'.format(dropReason, incomingCommand, commandID, self.puzzleID))
+      self.__sendAck(incomingCommand, commandID, receivedAt, None, None, dropReason, Request = message)
+      return
+    #end if
+
+    # Whatever was cued for later belongs to the game that's being reset
+    if incomingCommand in ['RESET', 'REBOOT']:
+      self.__cancelHeldCommands()
+    #end if
+
+    dueAt = None
+
+    if executeAt is not None:
+      try:
+        dueAt = time.monotonic() + (float(executeAt) - (clockOffset or 0)) - time.time()
+      except (TypeError, ValueError):
+        dueAt = None
+      #end try
+
+      if dueAt is not None and self.__maxCommandHold is not None and dueAt - time.monotonic() > self.__maxCommandHold:
+        print(' -> Rejected MQTT command: [{}] ({}) for puzzle ID [{}], its executeAt is {:.1f} seconds away'.format(incomingCommand, commandID, self.puzzleID, dueAt - time.monotonic()))
+        self.__commandFilter.Forget(commandID)
+        self.__sendAck(incomingCommand, commandID, receivedAt, None, None, 'too_far_ahead', Request = message)
+        return
+      #end if
+
+      # Held commands are let go by a timer of their own, so a busy heartbeat can't make them late.
+      # A command whose moment has already passed runs right away.
+      if dueAt is not None and dueAt > time.monotonic():
+        print(' -> Holding MQTT command: [{}] for puzzle ID [{}] for {:.3f} seconds'.format(incomingCommand, self.puzzleID, dueAt - time.monotonic()))
+
+        with self.__heldLock:
+          self.__heldSequence += 1
+          heldID = self.__heldSequence
+
+          # [scheduler job, command, command ID, received at, message]
+          self.__heldCommands[heldID] = [None, incomingCommand, commandID, receivedAt, message]
+          self.__heldCommands[heldID][0] = self.__connection.cueScheduler.CallAt(dueAt, lambda: self.__releaseHeldCommand(heldID, topicSegments, dueAt))
+        #end with
+
+        return
+      #end if
+    #end if
+
+    self.__runCommand(incomingCommand, commandID, receivedAt, message, topicSegments, DueAt = dueAt)
+  #end def (_HandleCommand)
+
+
+  # The connection dropped this command before it got to _HandleCommand(). It's NACKed with the
+  # reason, unless we've already sent too many of those lately.
+  def _RejectCommand(self, message, reason):
+
+    receivedAt = time.monotonic()
+
+    if self.__rejectReplies.Take() is False:
+      self.__suppressedRejectsTotal += 1
+      return
+    #end if
+
+    incomingCommand, commandID, issued, executeAt = DecodeCommand(message.payload)
+
+    print(' -> Dropped {} MQTT command: [{}] ({}) for puzzle ID [{}]'.format(reason, incomingCommand, commandID, self.puzzleID))
+    self.__sendAck(incomingCommand, commandID, receivedAt, None, None, reason, Request = message)
+  #end def (_RejectCommand)
+
+
+  def __releaseHeldCommand(self, heldID, topicSegments, dueAt):
+
+    with self.__heldLock:
+      held = self.__heldCommands.pop(heldID, None)
+    #end with
+
+    # Cancelled while it was on its way out
+    if held is None:
+      return
+    #end if
+
+    job, incomingCommand, commandID, receivedAt, message = held
+
+    self.__runCommand(incomingCommand, commandID, receivedAt, message, topicSegments, DueAt = dueAt, Urgent = True)
+  #end def (__releaseHeldCommand)
+
+
+  def __cancelHeldCommands(self):
+
+    with self.__heldLock:
+      cancelled = list(self.__heldCommands.values())
+      self.__heldCommands.clear()
+    #end with
+
+    for job, incomingCommand, commandID, receivedAt, message in cancelled:
+      self.__connection.cueScheduler.Cancel(job)
+
+      print(' -> Cancelled held MQTT command: [{}] ({}) for puzzle ID [{}]'.format(incomingCommand, commandID, self.puzzleID))
+      self.__sendAck(incomingCommand, commandID, receivedAt, None, None, 'cancelled', Request = message)
+    #end for
+  #end def (__cancelHeldCommands)
+
+
+  # DueAt is when (on the monotonic clock) a command with an executeAt was meant to happen, and the
+  # ack says how late its callback started. A command that was held until then is Urgent, and its
+  # callback goes ahead of any that are waiting.
+  def __runCommand(self, incomingCommand, commandID, receivedAt, message, topicSegments, DueAt = None, Urgent = False):
+
+    late = None if DueAt is None else time.monotonic() - DueAt
+
+    if incomingCommand == 'REBOOT':
+      print(' -> Received MQTT command: [{}] for puzzle ID [{}]'.format(incomingCommand, self.puzzleID))
+
+      self.__sendAck(incomingCommand, commandID, receivedAt, None, None, 'rebooting', Request = message, Late = late)
+      self.PublishStatus('REBOOTING')
+      self.__connection.disconnect()
+      # We fire the command_reboot callback in the on_disconnect event for the MQTT client
+
+    elif incomingCommand == 'PONG':
+      self._HandlePong(message, topicSegments)
+
+    elif incomingCommand == 'KEYFRAME':
+      self.__lastHeartbeat = None
+      self.SendPing()
+
+    elif incomingCommand in self.COMMAND_CALLBACKS:
+      print(' -> Received MQTT command: [{}] for puzzle ID [{}]'.format(incomingCommand, self.puzzleID))
+
+      def commandDone(queuedAt, startedAt, finishedAt, outcome):
+        self.__sendAck(incomingCommand, commandID, receivedAt, startedAt, finishedAt, outcome, Request = message, Late = None if DueAt is None else startedAt - DueAt)
+      #end def (commandDone)
+
+      if self.COMMAND_CALLBACKS[incomingCommand] not in self.__callbacks:
+        self.__sendAck(incomingCommand, commandID, receivedAt, None, None, 'unhandled', Request = message, Late = late)
+
+      elif self._SubmitCallback(self.COMMAND_CALLBACKS[incomingCommand], Done = commandDone, Urgent = Urgent) is False:
+        self.__commandFilter.Forget(commandID)
+        self.__sendAck(incomingCommand, commandID, receivedAt, None, None, 'dropped', Request = message, Late = late)
+      #end if
+
+    else:
+      self.__sendAck(incomingCommand, commandID, receivedAt, None, None, 'unknown', Request = message, Late = late)
+    #end if
+
+  #end def (__runCommand)
+
+
+  # The times handed in are off the monotonic clock, and go out on the wall clock. An MQTT v5
+  # Request that named a response topic is answered there, with its correlation data. Late (in
+  # seconds) is only sent for a command that had an executeAt.
+  def __sendAck(self, command, commandID, receivedAt, startedAt, finishedAt, outcome, Request = None, Late = None):
+
+    if self.__commandAcks is False:
+      return
+    #end if
+
+    wallOffset = time.time() - time.monotonic()
+
+    ack = {}
+    ack['command']  = command
+    ack['id']       = commandID
+    ack['received'] = receivedAt + wallOffset
+    ack['started']  = None if startedAt is None else startedAt + wallOffset
+    ack['finished'] = None if finishedAt is None else finishedAt + wallOffset
+    ack['outcome']  = outcome
+
+    if Late is not None:
+      ack['late'] = Late
+    #end if
+
+    requestProperties = getattr(Request, 'properties', None)
+    responseTopic = getattr(requestProperties, 'ResponseTopic', None) or 'CIPO/' + self.puzzleID + '/ACK'
+
+    self.__connection.Publish(responseTopic, json.dumps(ack), qos=1, CorrelationData=getattr(requestProperties, 'CorrelationData', None), Priority=OutboundQueue.PRIORITY_CRITICAL)
+  #end def (__sendAck)
+
+
+  def _HandlePong(self, message, topicSegments):
+    self.__connection.latency.PongReceived(self.puzzleID, message.payload)
+
+    self._SubmitCallback('pong')
+  #end def (_HandlePong)
+
+
+  def _HandleUnknownTopic(self, message, topicSegments):
+
+    if self.__errorReplies.Take() is False:
+      self.__suppressedErrors += 1
+      self.__suppressedErrorsTotal += 1
+      return
+    #end if
+
+    errorMessage = 'Unknown COMMAND received: [{}]'.format(message.payload.decode(errors='replace'))
+
+    if self.__suppressedErrors > 0:
+      errorMessage += ' ({} more since the last error were not answered)'.format(self.__suppressedErrors)
+      self.__suppressedErrors = 0
+    #end if
+
+    self.__connection.Publish('CIPO/' + self.puzzleID + '/ERROR', errorMessage)
+    self.PublishState(self.__puzzleState)
+  #end def (_HandleUnknownTopic)
+
+
+  # Peer events let one puzzle react to another without a trip through the room controller. The
+  # event goes to POPI/<peerID>/EVENT/<eventType> with a JSON payload like
+  #
+  #   {"from": "keys", "data": {"power": true}, "sent": 1571234567.89}
+  #
+  # and when the peer runs on this very connection it's handed over directly, without touching
+  # the broker at all. data can be anything json.dumps() can handle.
+  def SendPeerEvent(self, peerID, eventType, data = None, Qos = 1):
+
+    event = {}
+    event['from'] = self.puzzleID
+    event['data'] = data
+    event['sent'] = time.time()
+
+    payload = json.dumps(event)
+
+    localPeer = self.__connection.GetPuzzle(peerID)
+
+    if localPeer is not None:
+      localPeer._DeliverPeerEvent(eventType, json.loads(payload))
+      return None
+    #end if
+
+    return self.__connection.Publish('POPI/' + peerID + '/EVENT/' + eventType, payload, qos=Qos)
+  #end def (SendPeerEvent)
+
+
+  # handlerFunction(senderID, data) runs on this puzzle's callback thread for every peer event of
+  # eventType that comes our way.
+  def RegisterPeerEventHandler(self, eventType, handlerFunction):
+    self.__peerEventHandlers[eventType] = handlerFunction
+  #end def (RegisterPeerEventHandler)
+
+
+  def _HandlePeerEvent(self, message, topicSegments):
+
+    try:
+      event = json.loads(message.payload.decode())
+
+      if not isinstance(event, dict):
+        raise ValueError('not a JSON object')
+      #end if
+
+    except ValueError as e:
+      print('>> Ignoring malformed peer event on [{}]: [{}]'.format(message.topic, e))
+      return
+    #end try
+
+    self._DeliverPeerEvent(topicSegments[3], event)
+  #end def (_HandlePeerEvent)
+
+
+  def _DeliverPeerEvent(self, eventType, event):
+
+    if eventType not in self.__peerEventHandlers:
+      print(' -> No handler for peer event [{}] from [{}] for puzzle ID [{}]'.format(eventType, event.get('from'), self.puzzleID))
+      return
+    #end if
+
+    self.__executor.Submit(self.__peerEventHandlers[eventType], event.get('from'), event.get('data'))
+  #end def (_DeliverPeerEvent)
+
+
+  # Sends messages on any other topic (a POPI peer, for instance) to handler(message, topicSegments).
+  # Like the command callbacks, the handler runs on this puzzle's callback thread.
+  def RegisterTopicHandler(self, pattern, handlerFunction, Subscribe = False):
+
+    def submitHandler(message, topicSegments):
+      self.__executor.Submit(handlerFunction, message, topicSegments)
+    #end def (submitHandler)
+
+    self.__connection.AddRoute(pattern, submitHandler, Subscribe = Subscribe)
+  #end def (RegisterTopicHandler)
+
+
+  def PublishState(self, state):
+    if state is not None:
+      stateTopic = 'CIPO/' + self.puzzleID + '/STATE'
+      return self.__connection.Publish(stateTopic, state, qos=1, retain=self.__connection.RetainsPuzzleState(), CoalesceKey=stateTopic)
+    #end if
+
+    return None
+  #end def (PublishState)
+
+
+  def SendPing(self):
+
+    if self.__connection.IsConnected() is False:
+      return
+    #end if
+
+    if self.__connection._CheckLiveness(self.puzzleID) is False:
+      return
+    #end if
+
+    hostHeartbeat = self.__connection.hostHeartbeatInterval is not None
+
+    # With a host heartbeat the connection reports on the Pi itself, and we only need to say we're alive
+    #TODO - add wireless signal strength as well
+    data = {} if hostHeartbeat is True else self.__connection.telemetry.Snapshot()
+    data['timestamp']    = time.time()
+    data['puzzleID']     = self.puzzleID
+    data['role']         = 'puzzle'
+    data['currentStatus'] = self.__puzzleState
+
+    if hostHeartbeat is True:
+      data['hostID'] = self.__connection.hostID
+    else:
+      # Round trip percentiles and clock offset as of the last PONG
+      data.update(self.__connection.latency.GetHeartbeatReport())
+    #end if
+
+    # The number the next PONG should echo
+    data['pingSeq'] = self.__connection.latency.PingSent(self.puzzleID, data['timestamp'])
+
+    if self.__keyframeInterval:
+      json_data = self.__encodeSequencedHeartbeat(data)
+
+    elif self.__useCompactHeartbeat() is True:
+      json_data = EncodeHeartbeat(data)
+
+    else:
+      json_data = json.dumps(data)
+    #end if
+    
+    # A heartbeat that gets caught by a dropped link is only worth replaying for a couple of intervals
+    self.__connection.Publish('CIPO/PING/' + self.puzzleID, json_data, CoalesceKey='CIPO/PING/' + self.puzzleID, TimeToLive=self.GetHeartbeatInterval() * 2)
+
+    self.__timestampLastPing = time.time()
+
+    if self.__autoHeartbeat is True:
+      self.__scheduleHeartbeat()
+    #end if
+
+    # SendPing() runs on the network and scheduler threads too, which a slow callback mustn't hold up
+    self._SubmitCallback('ping')
+  
+  #end def
+  
+
+  def __encodeSequencedHeartbeat(self, data):
+
+    with self.__sequenceLock:
+      self.__heartbeatSequence += 1
+      self.__beatsSinceKeyframe += 1
+
+      if self.__lastHeartbeat is None or self.__beatsSinceKeyframe >= self.__keyframeInterval:
+        self.__lastHeartbeat = dict(data)
+        self.__beatsSinceKeyframe = 0
+
+        data['seq']      = self.__heartbeatSequence
+        data['keyframe'] = True
+
+        if self.__useCompactHeartbeat() is True:
+          return EncodeHeartbeat(data)
+        #end if
+
+        return json.dumps(data)
+      #end if
+
+      # Uptime is left out on purpose, the assembler works it out from the timestamp
+      delta = {key: value for key, value in data.items() if key != 'uptime' and self.__lastHeartbeat.get(key) != value}
+      delta['seq'] = self.__heartbeatSequence
+
+      self.__lastHeartbeat.update(data)
+    #end with
+
+    return json.dumps(delta, separators=(',', ':'))
+  #end def (__encodeSequencedHeartbeat)
+
+
+  def __useCompactHeartbeat(self):
+
+    if self.__heartbeatEncoding == 'auto':
+      advertisedSchema = self.__connection.heartbeatSchema
+      return advertisedSchema is not None and advertisedSchema >= HEARTBEAT_SCHEMA_VERSION
+    #end if
+
+    return self.__heartbeatEncoding == 'binary'
+  #end def (__useCompactHeartbeat)
+
+
+  def SetHeartbeatPolicy(self, policy):
+    self.__heartbeatPolicy = policy
+
+    # Pick up the new interval now rather than after the beat that's already scheduled
+    if self.__autoHeartbeat is True and self.__connection.IsConnected() is True:
+      self.__scheduleHeartbeat()
+    #end if
+  #end def (SetHeartbeatPolicy)
+
+
+  def GetHeartbeatInterval(self):
+
+    if self.__heartbeatPolicy is None:
+      return self.__pingDelay
+    #end if
+
+    if self.__puzzleState in self.__heartbeatPolicy:
+      return self.__heartbeatPolicy[self.__puzzleState]
+    #end if
+
+    return self.__heartbeatPolicy.get(None, self.__pingDelay)
+  #end def (GetHeartbeatInterval)
+
+
+  # Any ping (periodic, on connect or on a state change) pushes the next periodic one out by a
+  # full, slightly jittered interval so heartbeats from several puzzles don't bunch up.
+  def __scheduleHeartbeat(self):
+
+    delay = self.GetHeartbeatInterval() * random.uniform(1 - self.__pingJitter, 1 + self.__pingJitter)
+
+    with self.__heartbeatLock:
+      self.__connection.scheduler.Cancel(self.__heartbeatJob)
+      self.__heartbeatJob = self.__connection.scheduler.CallLater(delay, self.__heartbeatTick)
+    #end with
+  #end def (__scheduleHeartbeat)
+
+
+  def __heartbeatTick(self):
+
+    if self.__connection.IsConnected() is True:
+      self.SendPing()
+
+    else:
+      # Nothing to send while we're offline, just keep the beat going for when we're back
+      self.__scheduleHeartbeat()
+    #end if
+
+  #end def (__heartbeatTick)
+
+
+  def ProcessEvents(self):
+
+    # The scheduler owns heartbeat timing, there's nothing left for the host loop to do
+    if self.__autoHeartbeat is True:
+      return
+    #end if
+
+    if time.time() - self.__timestampLastPing > self.GetHeartbeatInterval():        # send a controller ping periodically
+      self.__timestampLastPing = time.time()
+      self.SendPing()
+    #end if
+        
+  #end def (ProcessLoop)
+
+
+  # For transitions that really matter (SOLVED at the end of a game, say) pass Deadline in seconds:
+  # the call then waits for the broker to acknowledge the STATE message and returns True if it
+  # did in time. Without a Deadline it returns straight away, as it always has.
+  def PublishStatus(self, newStatus, Deadline = None):
+    if newStatus in ['RESET', 'ACTIVE', 'SOLVED', 'FAILED', 'REBOOTING']:
+      self.__puzzleState = newStatus
+      messageInfo = self.PublishState(newStatus)
+
+      # Let the room controller's monitoring see the transition straight away
+      if self.__autoHeartbeat is True:
+        self.SendPing()
+      #end if
+
+      if Deadline is not None:
+        return self.__connection.WaitForPublish(messageInfo, Deadline)
+      #end if
+    #end if
+
+    return None
+  #end def
+  
+      
+  # These are the callbacks we will support at the moment:
+  # - command_reset 
+  # - command_activate
+  # - command_solve
+  # - command_reboot
+  # - pong
+  def RegisterCallback(self, eventName, callbackFunction):
+  
+    if eventName in ['command_reset', 'command_activate', 'command_solve', 'command_reboot', 'command_fail', 'pong', 'ping']:
+      self.__callbacks[eventName] = callbackFunction
+    #end if
+        
+  #end def (RegisterCallback)
+
+#end class (ControllerCommunications)
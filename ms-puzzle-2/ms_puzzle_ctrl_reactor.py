@@ -241,7 +241,8 @@ ReactorRoomController.RegisterCallback('command_fail',     handlerReactorRoomCon
 ReactorRoomController.RegisterCallback('ping',             handlerReactorRoomControllerPing)
 ReactorRoomController.RegisterCallback('pong',             handlerReactorRoomControllerPong)
 
-ReactorRoomController.connect()
+# Don't wait on the room controller, the puzzle is playable as soon as the GPIO is set up
+ReactorRoomController.connect(Blocking = False)
 ########################################################
 ## (END) ROOM CONTROL COMMUNICATION -> REACTOR PUZZLE ##
 ########################################################